@@ -2,8 +2,10 @@
 
 import os
 import sys
+import hashlib
 import random
 import collections
+import multiprocessing
 import zss
 from zss.test_tree import Node
 import numpy as np
@@ -18,37 +20,103 @@ import variga
 # import nonrandom
 # random = nonrandom.NonRandom([999999999, 0, 17] * 100)
 
-def evaluate(t, x):
-    if type(t) == type(""):
-        # it's a single string
+# numpy function names for the function nodes, for tree_expr
+expr_fns = {"+": "add", "-": "subtract", "*": "multiply",
+            "sin": "sin", "cos": "cos", "square": "square"}
+
+VAR, CONST, UNARY, BINARY = range(4)
+
+# the function nodes other than protected division
+node_ops = {"+": (BINARY, add), "-": (BINARY, subtract),
+            "*": (BINARY, multiply), "sin": (UNARY, sin),
+            "cos": (UNARY, cos), "square": (UNARY, square)}
+
+# parsed leaves, by leaf string: there are only as many as terminals
+leaf_ops = {}
+
+def leaf_op(t):
+    """(VAR, index into x) or (CONST, value) for the leaf string t,
+    parsed only the first time it is seen."""
+    op = leaf_ops.get(t)
+    if op is None:
         if t[0] == "x":
-            idx = int(t[1:])
-            return x[idx] 
-        elif t == "x": return x[0]
-        elif t == "y": return x[1]
+            op = (VAR, int(t[1:]))
+        elif t == "y":
+            op = (VAR, 1)
         else:
             try:
-                return float(t)
+                op = (CONST, float(t))
             except ValueError:
                 raise ValueError("Can't interpret " + t)
+        leaf_ops[t] = op
+    return op
+
+def evaluate(t, x):
+    if isinstance(t, str):
+        # it's a single string: a variable or a constant
+        op, arg = leaf_op(t)
+        if op == VAR:
+            return x[arg]
+        return arg
+    # it's a list: take t[0] and decide what to do
+    if t[0] == "/":
+        try:
+            return divide(evaluate(t[1], x), evaluate(t[2], x))
+        except FloatingPointError:
+            return evaluate(t[1], x)
+    op = node_ops.get(t[0])
+    if op is None:
+        raise ValueError("Can't interpret " + t[0])
+    if op[0] == BINARY:
+        return op[1](evaluate(t[1], x), evaluate(t[2], x))
+    return op[1](evaluate(t[1], x))
+
+class TreeFunction(object):
+    """The function represented by the tree t. Unlike a lambda, this
+    can be pickled, so individuals can be sent back from variga's
+    worker processes."""
+    def __init__(self, t):
+        self.t = t
+        self.key = None
+    def __call__(self, x):
+        return evaluate(self.t, x)
+    @property
+    def memo_key(self):
+        if self.key is None:
+            self.key = tree_key(self.t)
+        return self.key
+    def __str__(self):
+        return str(self.t)
+    @property
+    def expr(self):
+        return tree_expr(self.t)
+
+def tree_expr(t):
+    """Translate the tree t into an expression for
+    fitness.SymbolicRegressionFitnessFunction.get_semantics_batch,
+    with the same semantics as evaluate(). Division is "pdiv", the
+    protected division."""
+    if isinstance(t, str):
+        op, arg = leaf_op(t)
+        if op == VAR:
+            return ("x", arg)
+        return fitness.constant_expr(arg)
+    elif t[0] == "/":
+        return ("pdiv", tree_expr(t[1]), tree_expr(t[2]))
+    elif t[0] in ("sin", "cos", "square"):
+        return (expr_fns[t[0]], tree_expr(t[1]))
+    elif t[0] in ("+", "-", "*"):
+        return (expr_fns[t[0]], tree_expr(t[1]), tree_expr(t[2]))
     else:
-        # it's a list: take t[0] and decide what to do
-        if   t[0] == "+": return add(evaluate(t[1], x), evaluate(t[2], x))
-        elif t[0] == "-": return subtract(evaluate(t[1], x), evaluate(t[2], x))
-        elif t[0] == "*": return multiply(evaluate(t[1], x), evaluate(t[2], x))
-        elif t[0] == "/":
-            try:
-                return divide(evaluate(t[1], x), evaluate(t[2], x))
-            except FloatingPointError:
-                return evaluate(t[1], x)
-        elif t[0] == "sin": return sin(evaluate(t[1], x))
-        elif t[0] == "cos": return cos(evaluate(t[1], x))
-        elif t[0] == "square": return square(evaluate(t[1], x))
-        else:
-            raise ValueError("Can't interpret " + t[0])
+        raise ValueError("Can't interpret " + t[0])
+
+def tree_key(t):
+    """A hashable key for the tree t, equal for equal trees: its repr,
+    which is built in C, unlike a copy made of nested tuples."""
+    return repr(t)
 
 def make_fn(t):
-    return lambda x: evaluate(t, x)
+    return TreeFunction(t)
 
 def traverse(t, path=None):
     """Depth-first traversal of the tree t, yielding at each step the
@@ -191,14 +259,103 @@ def make_zssNode_from_tuple(t):
         n.addkid(make_zssNode_from_tuple(s))
     return n
 
-def tree_distance(t, s):
-    # print(t)
-    # print(s)
+class AnnotatedTree(object):
+    """A tree prepared for tree_distance: the labels of its nodes in
+    postorder, the leftmost leaf descendant of each, the keyroots, and
+    a histogram of the labels. The nodes are those of
+    make_zssNode_from_tuple(t), so a leaf string s is a node labelled
+    s[0] with a child for each character of s[1:]. Build it once per
+    tree, eg with structure.PHENOTYPE_PREPARE."""
+    def __init__(self, t):
+        self.t = t
+        self.labels = []
+        self.lmds = []
+        self.annotate(t)
+        keyroots = {}
+        for i, lmd in enumerate(self.lmds):
+            keyroots[lmd] = i
+        self.keyroots = sorted(keyroots.values())
+        self.histogram = collections.Counter(self.labels)
+
+    def annotate(self, t):
+        first = len(self.labels)
+        for s in t[1:]:
+            self.annotate(s)
+        self.lmds.append(first)
+        self.labels.append(t[0])
+
+# strdist(a, b) for pairs of labels
+label_distances = {}
+
+def label_distance(a, b):
+    try:
+        return label_distances[a, b]
+    except KeyError:
+        d = label_distances[a, b] = zss.compare.strdist(a, b)
+        return d
+
+def tree_distance(t, s, max_dist=None):
+    """The Zhang-Shasha tree edit distance between t and s, nested
+    lists or AnnotatedTrees, with the same costs and results as
+    zss.compare.distance on make_zssNode_from_tuple(t) and (s). If
+    max_dist is given and tree_distance_lower_bound shows the distance
+    is greater, return the bound instead."""
     assert(t is not None)
     assert(s is not None)
-    tN = make_zssNode_from_tuple(t)
-    sN = make_zssNode_from_tuple(s)
-    return zss.compare.distance(tN, sN)
+    if not isinstance(t, AnnotatedTree):
+        t = AnnotatedTree(t)
+    if not isinstance(s, AnnotatedTree):
+        s = AnnotatedTree(s)
+    if t.t == s.t:
+        return 0.0
+    if max_dist is not None:
+        bound = tree_distance_lower_bound(t, s)
+        if bound > max_dist:
+            return float(bound)
+    return zhang_shasha(t, s)
+
+def tree_distance_lower_bound(t, s):
+    """A cheap lower bound on tree_distance(t, s), for AnnotatedTrees:
+    every node of the larger tree which can't be matched with a node of
+    the other with the same label costs at least 1."""
+    common = sum((t.histogram & s.histogram).values())
+    return max(len(t.labels), len(s.labels)) - common
+
+def zhang_shasha(A, B):
+    la, lb = A.labels, B.labels
+    Al, Bl = A.lmds, B.lmds
+    remove = [label_distance(a, "") for a in la]
+    insert = [label_distance("", b) for b in lb]
+    treedists = [[0.0] * len(lb) for a in la]
+    for i in A.keyroots:
+        for j in B.keyroots:
+            ioff = Al[i] - 1
+            joff = Bl[j] - 1
+            m = i - Al[i] + 2
+            n = j - Bl[j] + 2
+            fd = [[0.0] * n for x in range(m)]
+            for x in range(1, m):
+                fd[x][0] = fd[x-1][0] + remove[x+ioff]
+            for y in range(1, n):
+                fd[0][y] = fd[0][y-1] + insert[y+joff]
+            for x in range(1, m):
+                xi = x + ioff
+                prev, row, td = fd[x-1], fd[x], treedists[xi]
+                rm = remove[xi]
+                whole_a = Al[xi] == Al[i]
+                for y in range(1, n):
+                    yj = y + joff
+                    if whole_a and Bl[yj] == Bl[j]:
+                        # both forests are whole trees
+                        row[y] = td[yj] = min(
+                            prev[y] + rm, row[y-1] + insert[yj],
+                            prev[y-1] + label_distance(la[xi], lb[yj]))
+                    else:
+                        p = Al[xi] - 1 - ioff
+                        q = Bl[yj] - 1 - joff
+                        row[y] = min(prev[y] + rm, row[y-1] + insert[yj],
+                                     fd[p][q] + td[yj])
+    return treedists[-1][-1]
 
 def semantic_distance(v, u):
     """FIXME Inputs are vectors of numbers, ie values at fitness
@@ -236,13 +393,72 @@ generate_grow_fn = lambda rng: generate_grow_tree_and_fn(rng)[1]
 def success(err):
     return False # let's just keep running so all runs are same length
 
-def study_structure(basename, rep="bubble_down"):
+# Attempts per chunk of work in study_structure. Each chunk has its
+# own seed, so the results don't depend on how many processes share
+# the work.
+STUDY_CHUNK = 1000
+
+def chunk_seed(seed, kind, i):
+    """An integer seed for the chunk of work for kind starting at
+    attempt i. It's derived with sha1, because seeding with a string
+    uses its hash(), which differs between platforms."""
+    digest = hashlib.sha1("%d %s %d" % (seed, kind, i)).hexdigest()
+    return int(digest[:15], 16)
+
+def study_chunk(args):
+    """Make count attempts with the pair generator for the given kind
+    of operator (random, mutation or crossover), seeded with seed.
+    Return the distances for the non-neutral pairs, and the numbers of
+    valid and neutral pairs."""
+    kind, count, seed = args
+    random.seed(seed)
+    generate_pairs = getattr(structure, "generate_%s_pairs" % kind)
+    rows = []
+    valid = 0
+    neutral = 0
+    for g, h in generate_pairs(count):
+        valid += 1
+        ds = structure.distances(g, h)
+        if ds[1] > 0:
+            rows.append(ds)
+        else:
+            neutral += 1
+    return rows, valid, neutral
+
+def study_operator(basename, rep, kind, n, seed, pool, binary=False):
+    print(kind)
+    chunks = [(kind, min(STUDY_CHUNK, n - i), chunk_seed(seed, kind, i))
+              for i in range(0, n, STUDY_CHUNK)]
+    if pool is None:
+        results = (study_chunk(chunk) for chunk in chunks)
+    else:
+        results = pool.imap(study_chunk, chunks)
+    filename = os.path.join(basename, rep, kind + "_distances" +
+                            (".npy" if binary else ".dat"))
+    with structure.DistanceWriter(filename, binary) as outfile:
+        total_count = 0
+        neutral_count = 0
+        # results arrive in order, so we can write them as they come
+        for rows, valid, neutral in results:
+            outfile.write_rows(rows)
+            total_count += valid
+            neutral_count += neutral
+    print("%s attempted trials %d, valid %d, neutral %d" % (
+            kind, n, total_count, neutral_count))
+
+def study_structure(basename, rep="bubble_down", n=10000, nprocs=1,
+                    seed=None, binary=False):
     """Use structure.py to investigate the structure of the tree-based
-    GP space: can do bubble-down or grow algorithm."""
+    GP space: can do bubble-down or grow algorithm. Makes n attempts
+    at pairs of individuals for each kind of operator, spread over
+    nprocs worker processes. The same seed gives the same results
+    whatever nprocs is. Writes text .dat files, or if binary, .npy
+    files (see structure.DistanceWriter)."""
     structure.MINLEN = 100
     structure.MAXLEN = 100
     structure.SEMANTIC_DISTANCE = semantic_distance
     structure.PHENOTYPE_DISTANCE = tree_distance
+    structure.PHENOTYPE_PREPARE = AnnotatedTree
     structure.FITNESS = semantics
     structure.CROSSOVER_PROB = 1.0
     structure.MAXV = sys.maxint
@@ -255,47 +471,16 @@ def study_structure(basename, rep="bubble_down"):
     else:
         raise ValueError
     structure.MAXIMISE = False
-    n = 10000
+    if seed is None:
+        seed = random.randint(0, sys.maxint)
     print(rep)
-    print("random")
-    with open(os.path.join(basename, rep, "random_distances.dat"), "w") as outfile:
-        total_count = 0
-        neutral_count = 0
-        for g, h in structure.generate_random_pairs(n):
-            total_count += 1
-            ds = structure.distances(g, h)
-            if ds[1] > 0:
-                outfile.write("%d %d %f %f\n" % (ds))
-            else:
-                neutral_count += 1
-        print("random attempted trials %d, valid %d, neutral %d" % (
-                n, total_count, neutral_count))
-    print("mutation")
-    with open(os.path.join(basename, rep, "mutation_distances.dat"), "w") as outfile:
-        total_count = 0
-        neutral_count = 0
-        for g, h in structure.generate_mutation_pairs(n):
-            total_count += 1
-            ds = structure.distances(g, h)
-            if ds[1] > 0:
-                outfile.write("%d %d %f %f\n" % (ds))
-            else:
-                neutral_count += 1
-        print("mutation attempted trials %d, valid %d, neutral %d" % (
-                n, total_count, neutral_count))
-    print("crossover")
-    with open(os.path.join(basename, rep, "crossover_distances.dat"), "w") as outfile:
-        total_count = 0
-        neutral_count = 0
-        for g, c in structure.generate_crossover_pairs(n):
-            total_count += 1
-            ds = structure.distances(g, c)
-            if ds[1] > 0:
-                outfile.write("%d %d %f %f\n" % (ds))
-            else:
-                neutral_count += 1
-        print("crossover attempted trials %d, valid %d, neutral %d" % (
-                n, total_count, neutral_count))
+    pool = multiprocessing.Pool(nprocs) if nprocs > 1 else None
+    try:
+        for kind in ["random", "mutation", "crossover"]:
+            study_operator(basename, rep, kind, n, seed, pool, binary)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 def test():
     t, dep, nnodes = bubble_down(random.randint(5, 19), random)
@@ -318,6 +503,21 @@ def test():
     tf = make_fn(t)
     print(tf(cases))
 
+def benchmark(n=200, reps=20):
+    """Time TreeFunction on srff's training data, calling each of n
+    trees reps times, and check it agrees with evaluate()."""
+    import time
+    trees = [bubble_down(30, random)[0] for i in range(n)]
+    x = srff.train_X
+    expected = [evaluate(t, x) for t in trees]
+    start = time.time()
+    for t, e in zip(trees, expected):
+        f = TreeFunction(t)
+        for i in range(reps):
+            assert np.array_equal(f(x), e)
+    print("TreeFunction %.1fus per call" % (
+            1e6 * (time.time() - start) / (n * reps)))
+
 def test_grow():
     for i in range(7):
         print(grow(i, random))
@@ -333,6 +533,7 @@ def run(rep="bubble_down"):
         variga.GENERATE = generate_grow_fn
     else:
         raise ValueError
+    variga.FITNESS_BATCH = srff.fitness_batch
     variga.MAXIMISE = False
     variga.SUCCESS = success
     variga.POPSIZE = 4000
@@ -342,6 +543,7 @@ def run(rep="bubble_down"):
     variga.ELITE = 1
     variga.TOURNAMENT_SIZE = 3
     variga.WRAPS = 1
+    variga.NEUTRAL_SKIP = True
     variga.main()
 
 def semantics(fn):
@@ -367,10 +569,13 @@ if __name__ == "__main__":
         test()
     elif sys.argv[1] == "test_grow":
         test_grow()
-    elif sys.argv[1] == "grow_structure":
-        study_structure(sys.argv[2], "grow")
-    elif sys.argv[1] == "bubble_down_structure":
-        study_structure(sys.argv[2], "bubble_down")
+    elif sys.argv[1] == "benchmark":
+        benchmark()
+    elif sys.argv[1] in ("grow_structure", "bubble_down_structure"):
+        # optional arguments: number of attempts, processes, seed,
+        # and 1 for binary output
+        args = map(int, sys.argv[3:])
+        study_structure(sys.argv[2], sys.argv[1][:-len("_structure")], *args)
     elif sys.argv[1] == "run_bubble_down":
         run("bubble_down")
     elif sys.argv[1] == "run_grow":
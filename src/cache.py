@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import sys
+import collections
+
+class LRUCache(object):
+    """A dictionary holding at most maxsize items. When it is full,
+    adding an item discards the least recently used one. If on_evict
+    is given, it is called with the key and value of each discarded
+    item. Alternatively or as well, the cache can be limited to
+    maxbytes, where sizeof(key, value) gives the (estimated) size of
+    an item. Counts hits and misses, so we can see how much work the
+    cache is saving."""
+
+    def __init__(self, maxsize=10000, on_evict=None,
+                 maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as recently used, or
+        default if it's not present."""
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.data:
+            self._discard(key, self.data.pop(key))
+        self.data[key] = value
+        if self.sizeof is not None:
+            self.nbytes += self.sizeof(key, value)
+        while len(self.data) > self.maxsize or (
+            self.maxbytes is not None and self.nbytes > self.maxbytes
+            and len(self.data) > 1):
+            old_key, old_value = self.data.popitem(last=False)
+            self._discard(old_key, old_value)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def _discard(self, key, value):
+        if self.sizeof is not None:
+            self.nbytes -= self.sizeof(key, value)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+
+class PrefixCache(object):
+    """An LRU cache for values which depend only on a prefix of a
+    sequence, eg an individual, which depends only on the codons
+    which the mapping actually used. A value stored with a prefix
+    length n is returned for any sequence which starts with the same n
+    items. A value stored with n=None depends on the whole sequence,
+    and is returned only for an equal sequence. key turns a sequence
+    into something hashable, for those. The prefixes are kept in a
+    path-compressed trie, so a lookup walks the sequence only as far
+    as the first stored prefix, or the first item no stored prefix
+    shares, and each stored prefix costs one node, however long it
+    is. A lookup counts as one hit or one miss.
+
+    Like LRUCache, the cache holds at most maxsize items, and if
+    maxbytes is given, roughly at most that many bytes, counting each
+    entry's key and trie node, plus sizeof(value) if sizeof is
+    given."""
+
+    def __init__(self, maxsize=10000, key=tuple, maxbytes=None, sizeof=None):
+        self.key = key
+        self.value_size = sizeof
+        self.cache = LRUCache(maxsize, self._evicted, maxbytes, self._sizeof)
+        # A node is a dict from the first item of each edge out of it
+        # to the edge, a list [label, child], where label is the list
+        # of items along the edge. Under None, a node holds the cache
+        # key of the prefix which ends there.
+        self.trie = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _sizeof(self, key, value):
+        n, k = key
+        size = sys.getsizeof(k)
+        if isinstance(k, tuple):
+            size += INT_BYTES * len(k)
+        if n is not None:
+            # the edge's label, and the node
+            size += POINTER_BYTES * n + NODE_BYTES
+        if self.value_size is not None:
+            size += self.value_size(value)
+        return size
+
+    def _evicted(self, key, value):
+        n, prefix = key
+        if n is None:
+            return
+        path = [] # (node, first item of the edge we took)
+        node = self.trie
+        i = 0
+        while i < n:
+            path.append((node, prefix[i]))
+            label, node = node[prefix[i]]
+            i += len(label)
+        del node[None]
+        # remove the node if it's empty, and merge an edge into its
+        # parent's if it's now the only way through a node
+        while path:
+            parent, first = path.pop()
+            edge = parent[first]
+            if not node:
+                del parent[first]
+                node = parent
+                continue
+            if len(node) == 1 and None not in node:
+                label, child = next(iter(node.values()))
+                edge[0] = edge[0] + label
+                edge[1] = child
+            break
+
+    def get(self, seq, default=None):
+        k = (None, self.key(seq))
+        if k not in self.cache.data:
+            k = self._find(items(seq))
+        if k is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self.cache.get(k)
+
+    def _find(self, seq):
+        """The key of the first stored prefix of seq, or None."""
+        node = self.trie
+        i = 0
+        n = len(seq)
+        while True:
+            if None in node:
+                return node[None]
+            if i >= n:
+                return None
+            edge = node.get(seq[i])
+            if edge is None:
+                return None
+            label, node = edge
+            if seq[i:i + len(label)] != label:
+                return None
+            i += len(label)
+
+    def put(self, seq, n, value):
+        if n is None:
+            k = (None, self.key(seq))
+        else:
+            prefix = list(items(seq[:n]))
+            k = (n, tuple(prefix))
+            node = self.trie
+            i = 0
+            while i < n:
+                edge = node.get(prefix[i])
+                if edge is None:
+                    child = {}
+                    node[prefix[i]] = [prefix[i:], child]
+                    node = child
+                    break
+                label = edge[0]
+                m = min(len(label), n - i)
+                j = 1
+                while j < m and label[j] == prefix[i + j]:
+                    j += 1
+                if j < len(label):
+                    # split the edge where the prefix leaves it
+                    edge[1] = {label[j]: [label[j:], edge[1]]}
+                    edge[0] = label[:j]
+                node = edge[1]
+                i += j
+            node[None] = k
+        self.cache.put(k, value)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+
+# Rough sizes for PrefixCache's byte counts (64-bit CPython 2).
+INT_BYTES = 24
+POINTER_BYTES = 8
+NODE_BYTES = 400
+
+def items(seq):
+    """The items of seq as a list, of plain Python values if it's a
+    numpy array (much faster to hash than numpy scalars)."""
+    if hasattr(seq, "tolist"):
+        return seq.tolist()
+    return seq if isinstance(seq, list) else list(seq)
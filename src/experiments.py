@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import sys
 import multiprocessing
 import numpy as np
 import os
@@ -29,26 +30,53 @@ def gp_distances_boxplots(basedir):
         
     print(r"\end{tabular}")        
 
+def read_dat(filename):
+    """Read a text distances file into a list of (g, p, s, f)."""
+    txt = open(filename).read()
+    _data = []
+    for line in txt.split("\n"):
+        if len(line) < 2: continue
+        parts = line.split()
+        g, p, s, f = parts
+        g = int(g)
+        p = int(p)
+        s = float(s)
+        f = float(f)
+        _data.append((g, p, s, f))
+    return _data
+
+def read_distances(basedir, rep, op):
+    """Return the four columns of distances for rep and op, leaving
+    out pairs with genotype distance 0. Prefers the binary .npy file,
+    which is memory-mapped rather than parsed, else reads the .dat
+    text file."""
+    filename = os.path.join(basedir, rep, op + "_distances")
+    if os.path.exists(filename + ".npy"):
+        d = np.load(filename + ".npy", mmap_mode="r")
+        d = d[d["genotype"] != 0]
+        return [d[name] for name in d.dtype.names]
+    _data = [row for row in read_dat(filename + ".dat") if row[0] != 0]
+    _data = np.array(_data)
+    return _data.transpose()
+
+def convert(basedir):
+    """Convert all the text distances files under basedir to binary
+    .npy files, alongside them."""
+    from structure import DistanceWriter
+    for dirpath, dirnames, filenames in os.walk(basedir):
+        for name in filenames:
+            if name.endswith("_distances.dat"):
+                filename = os.path.join(dirpath, name)
+                print("converting " + filename)
+                with DistanceWriter(filename[:-len(".dat")] + ".npy",
+                                    binary=True) as outfile:
+                    outfile.write_rows(read_dat(filename))
+
 def process(basedir, ops, rep):
     data = {}
     dtypes = ["genotype", "phenotype", "semantics", "fitness"]
     for op in ops:
-        filename = os.path.join(basedir, rep, op + "_distances.dat")
-        txt = open(filename).read()
-        _data = []
-        for line in txt.split("\n"):
-            if len(line) < 2: continue
-            parts = line.split()
-            g, p, s, f = parts
-            g = int(g)
-            p = int(p)
-            s = float(s)
-            f = float(f)
-            if g == 0: continue
-            _data.append((g, p, s, f))
-        _data = np.array(_data)
-        _data = _data.transpose()
-        data[op] = _data
+        data[op] = read_distances(basedir, rep, op)
     
     for i, d in enumerate(dtypes):
         bpdata = [data[op][i] for op in ops]
@@ -127,4 +155,7 @@ def print_data(rep, dist, bpdata):
     # print(r"\end{tabular}")        
                 
 if __name__ == "__main__":
-    gp_distances_boxplots(sys.argv[1])
+    if sys.argv[1] == "convert":
+        convert(sys.argv[2])
+    else:
+        gp_distances_boxplots(sys.argv[1])
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
+import os
+import re
 import sys
+import ast
+import glob
+import hashlib
+import time
 import random
 import operator
-from itertools import product
+import collections
 import numpy as np
 from numpy import add, subtract, multiply, divide, sin, cos, exp, log, power, square
 from numpy import logical_and, logical_or, logical_xor, logical_not
@@ -13,6 +19,7 @@ try:
 except:
     # StringMatch won't be available. Try: $ pip install editdist
     pass
+import cache
 
 
 def eval_or_exec(expr):
@@ -44,6 +51,163 @@ def eval_or_exec(expr):
         retval = None
     return retval
 
+class CompiledCache:
+    """A size-bounded cache from phenotype strings, eg "lambda x:
+    add(x[0], 0.1)", to the code objects they compile to and the
+    functions they evaluate to. The same strings turn up again and
+    again through elitism and convergence, so this saves compiling
+    them every time. Also keeps track of the time spent compiling, the
+    compile time saved by hits, and the time spent running the
+    functions, since the last report. Each process has its own cache,
+    so with variga's worker pool the counts in the main process only
+    cover the work done there. Strings are evaluated in namespace,
+    by default this module's globals."""
+    def __init__(self, maxsize=10000, namespace=None):
+        self.cache = cache.LRUCache(maxsize)
+        self.namespace = namespace
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.cache.reset_counts()
+        self.compile_time = 0.0
+        self.saved_time = 0.0
+        self.eval_time = 0.0
+
+    def get(self, s):
+        """Return the function s evaluates to. MemoryError is raised
+        as by eval() if s is too deeply nested."""
+        entry = self.cache.get(s)
+        if entry is not None:
+            code, fn, t = entry
+            self.saved_time += t
+            return fn
+        start = time.time()
+        code = compile(s, "<phenotype>", "eval")
+        fn = eval(code, self.namespace or globals())
+        t = time.time() - start
+        self.compile_time += t
+        self.cache.put(s, (code, fn, t))
+        return fn
+
+    def run(self, fn, x):
+        """Call fn(x), timing it."""
+        start = time.time()
+        try:
+            return fn(x)
+        finally:
+            self.eval_time += time.time() - start
+
+    def report(self):
+        """Return a one-line summary of the counts, and reset them."""
+        s = ("compiled_hits %d compiled_misses %d compile_time %.3f "
+             "compile_time_saved %.3f eval_time %.3f" % (
+                self.cache.hits, self.cache.misses, self.compile_time,
+                self.saved_time, self.eval_time))
+        self.reset_counts()
+        return s
+
+# Shared by all the fitness functions which accept strings.
+COMPILED = CompiledCache()
+
+# For bit-packed Boolean problems, where the logical ufuncs must act
+# bit by bit on words of packed cases, and True and False stand for
+# words of all ones and all zeros.
+PACKED_COMPILED = CompiledCache(namespace=dict(
+        globals(), logical_and=np.bitwise_and, logical_or=np.bitwise_or,
+        logical_xor=np.bitwise_xor, logical_not=np.invert,
+        True=np.uint64(2 ** 64 - 1), False=np.uint64(0)))
+
+# Number of bits set in each byte value.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def pack_cases(a):
+    """Pack the last axis of the bool array a into uint64 words, 64
+    cases per word. The last word is padded with False."""
+    a = np.asarray(a, dtype=bool)
+    nwords = (a.shape[-1] + 63) // 64
+    padded = np.zeros(a.shape[:-1] + (nwords * 64,), dtype=bool)
+    padded[..., :a.shape[-1]] = a
+    return np.packbits(padded, axis=-1).view(np.uint64)
+
+def popcount(words):
+    """Total number of bits set in an array of words."""
+    return int(POPCOUNT[np.ascontiguousarray(words).view(np.uint8)].sum())
+
+def phenotype_key(fn):
+    """A hashable key standing for the phenotype fn, for memoizing its
+    fitness: the string itself, or fn.memo_key for callables which
+    provide one, eg bubble_down's trees. None if fn can't be
+    memoized."""
+    if isinstance(fn, str):
+        return fn
+    return getattr(fn, "memo_key", None)
+
+def semantics_size(key, result):
+    """Estimated memory used by a memoized (fitness, semantics)
+    result, including its key."""
+    fit, vals = result
+    return 200 + getattr(vals, "nbytes", 0) + sys.getsizeof(key)
+
+# Expressions are nested tuples which describe a phenotype for
+# batched evaluation (see get_semantics_batch): ("x", i) is input
+# variable i, ("c", repr(v), v) is the constant v, and (name, arg, ...)
+# applies one of EXPR_FNS, or "pdiv", protected division, which
+# returns its first argument if the division fails.
+EXPR_FNS = {
+    "add": add, "subtract": subtract, "multiply": multiply,
+    "divide": divide, "sin": sin, "cos": cos, "exp": exp, "log": log,
+    "power": power, "square": square
+    }
+
+# Marks a subexpression whose evaluation raised FloatingPointError.
+FAILED = "FAILED"
+
+def constant_expr(v):
+    """The expression for the constant v. The repr keeps eg 1 and 1.0,
+    or 0.0 and -0.0, apart."""
+    return ("c", repr(v), v)
+
+def parse_expr(s):
+    """Turn a phenotype string such as "lambda x: add(x[0], 0.1)" into
+    an expression. Return None if it uses anything other than calls to
+    EXPR_FNS, x[i] and numbers, or is too deeply nested to parse."""
+    def conv(node):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in EXPR_FNS and not node.keywords
+            and node.starargs is None and node.kwargs is None):
+            return (node.func.id,) + tuple(conv(arg) for arg in node.args)
+        elif (isinstance(node, ast.Subscript)
+              and isinstance(node.value, ast.Name) and node.value.id == x
+              and isinstance(node.slice, ast.Index)
+              and isinstance(node.slice.value, ast.Num)
+              and isinstance(node.slice.value.n, int)):
+            return ("x", node.slice.value.n)
+        elif isinstance(node, ast.Num):
+            return constant_expr(node.n)
+        else:
+            raise ValueError
+    try:
+        lam = ast.parse(s, mode="eval").body
+        if not (isinstance(lam, ast.Lambda) and len(lam.args.args) == 1
+                and isinstance(lam.args.args[0], ast.Name)):
+            return None
+        x = lam.args.args[0].id
+        return conv(lam.body)
+    except (SyntaxError, ValueError, MemoryError, RuntimeError):
+        return None
+
+def phenotype_expr(fn):
+    """The expression for the phenotype fn: parsed from a string, or
+    fn.expr for callables which provide one, eg bubble_down's trees.
+    None if fn can't be described as an expression."""
+    if isinstance(fn, str):
+        return parse_expr(fn)
+    return getattr(fn, "expr", None)
+
+def node_size(key, value):
+    """Estimated memory used by a cached subexpression value."""
+    return 100 + getattr(value, "nbytes", 0)
+
 def default_fitness(maximise):
     """Return default (worst) fitness, given maximization or
     minimization."""
@@ -114,17 +278,26 @@ class StringProc():
 
 class BooleanProblem:
     """Boolean problem of size n. Pass target function in.
-    Minimises. Objects of this type can be called."""
+    Minimises. Objects of this type can be called.
+
+    If packed is True, use a sub-machine code implementation: each
+    variable's cases are packed into uint64 words, so each bitwise
+    operation evaluates 64 cases at once, and errors are counted by
+    popcount. The phenotype then sees x[i] as an array of words, so it
+    must use only bitwise operations: &, |, ^, ~ and the logical_*
+    ufuncs, which are replaced by their bitwise equivalents, and the
+    constants True and False. This makes
+    eg even-n parity practical for n up to 20 and more."""
 
-    # TODO could benchmark this versus sub-machine code
-    # implementation.
-    def __init__(self, n, target):
+    def __init__(self, n, target, packed=False):
         self.maximise = False
-        
-        # make all possible fitness cases
-        vals = [False, True]
-        p = list(product(*[vals for i in range(n)]))
-        self.x = np.transpose(p)
+        self.packed = packed
+
+        # make all possible fitness cases, in the same order as
+        # itertools.product: variable 0 varies slowest.
+        cases = np.arange(2 ** n)
+        self.x = np.array([(cases >> (n - 1 - i)) & 1
+                           for i in range(n)], dtype=bool)
 
         # get target function's values on fitness cases
         try:
@@ -138,10 +311,24 @@ class BooleanProblem:
                 raise ValueError(s)
             self.target_cases = np.array(target)
 
+        if packed:
+            self.x = pack_cases(self.x)
+            self.target_cases = pack_cases(
+                np.broadcast_to(self.target_cases, (2 ** n,)))
+            # the bits which are real cases, not padding
+            self.mask = pack_cases(np.ones(2 ** n, dtype=bool))
+
     def __call__(self, s):
         # s is a string which evals to a fn.
-        fn = eval(s)
-        output = fn(self.x)
+        if self.packed:
+            fn = PACKED_COMPILED.get(s)
+            output = PACKED_COMPILED.run(fn, self.x)
+            if np.ndim(output) == 0:
+                output = self.mask if output else np.zeros_like(self.mask)
+            non_matches = (output ^ self.target_cases) & self.mask
+            return popcount(non_matches) # Fitness is number of errors
+        fn = COMPILED.get(s)
+        output = COMPILED.run(fn, self.x)
         non_matches = output ^ self.target_cases
         return sum(non_matches) # Fitness is number of errors
     
@@ -154,13 +341,14 @@ class BooleanProblemGeneral:
     several sizes. Some sizes are used for training, some for
     testing. Training fitness is the sum of fitness on the training
     sub-problems. Testing fitness is the sum of fitness on the testing
-    sub-problems."""
-    def __init__(self, train_ns, test_ns, target):
+    sub-problems. If packed is True, the sub-problems are bit-packed
+    (see BooleanProblem)."""
+    def __init__(self, train_ns, test_ns, target, packed=False):
         self.maximise = False
         self.train_problems = [
-            BooleanProblem(n, target) for n in train_ns]
+            BooleanProblem(n, target, packed) for n in train_ns]
         self.test_problems = [
-            BooleanProblem(n, target) for n in test_ns]
+            BooleanProblem(n, target, packed) for n in test_ns]
     def __call__(self, s):
         return sum([p(s) for p in self.train_problems])
     def test(self, s):
@@ -178,7 +366,7 @@ class ProbabilityDistribution:
         if not callable(fn):
             # assume fn is a string which evals to a function.
             try:
-                fn = eval(fn)
+                fn = COMPILED.get(fn)
             except MemoryError:
                 return default_fitness(self.maximise), None
 
@@ -219,27 +407,152 @@ class SymbolicRegressionFitnessFunction:
             self.defn = self.hits_fitness
         else:
             raise ValueError("Bad value for fitness definition: " + defn)
+        self.memo_bytes = None
+        self.train_memo = None
+        self.test_memo = None
+        self.node_cache_bytes = 2 ** 26
+        self.train_nodes = None
+        self.test_nodes = None
+        # see set_cases
+        self.all_train_X = train_X
+        self.all_train_y = train_y
+        self.cases = None
+        self.full_caches = None
+        self.racing_cases = None
+
+    def memoize(self, max_bytes=2 ** 27):
+        """Turn on memoization of get_semantics, keyed on the
+        phenotype (see phenotype_key). Training and testing results
+        are kept separately, each in an LRU cache of roughly at most
+        max_bytes."""
+        self.memo_bytes = max_bytes
+        self.train_memo = self.new_memo()
+        self.test_memo = self.new_memo()
+
+    def new_memo(self):
+        """An empty memo for get_semantics, or None if memoize() hasn't
+        been called."""
+        if self.memo_bytes is None:
+            return None
+        return cache.LRUCache(sys.maxint, maxbytes=self.memo_bytes,
+                              sizeof=semantics_size)
+
+    def select_cases(self, gen, schedule="full", sample=0.1, rng=np.random):
+        """Choose the training cases for generation gen, for
+        set_cases, according to schedule:
+
+        full: all of them, every generation.
+        minibatch: a new random sample every generation.
+        interleaved: all of them in even generations, a new random
+        sample in odd ones.
+        racing: one random sample, drawn the first time, which every
+        individual in every generation is raced on.
+
+        sample is either a proportion of the cases, a float below
+        1.0, eg 0.1 for a tenth of them, or a number of cases, an int,
+        eg 50. Other floats, including 1.0, raise ValueError: for all
+        the cases, use the full schedule. Samples are drawn with rng.
+        Return the indices of the cases, in order, or None for all."""
+        if schedule == "full" or (schedule == "interleaved" and gen % 2 == 0):
+            return None
+        if schedule == "racing" and self.racing_cases is not None:
+            return self.racing_cases
+        if schedule not in ("minibatch", "interleaved", "racing"):
+            raise ValueError("Bad value for case schedule: " + schedule)
+        n = len(self.all_train_y)
+        if isinstance(sample, float) and 0.0 < sample < 1.0:
+            k = int(round(sample * n))
+        elif isinstance(sample, (int, long)) and sample >= 1:
+            k = sample
+        else:
+            raise ValueError("Bad value for case sample: %r (want a "
+                             "proportion below 1.0, or a count)" % (sample,))
+        cases = np.sort(rng.choice(n, max(1, min(k, n)), replace=False))
+        if schedule == "racing":
+            self.racing_cases = cases
+        return cases
+
+    def set_cases(self, cases):
+        """Evaluate on just the training cases with indices cases, eg
+        from select_cases, or on all of them if cases is None:
+        train_X and train_y become those cases, and all_train_X and
+        all_train_y keep the lot. While a subset is in use, the memo
+        and node caches for the full set are put aside, and those for
+        each new subset start empty. Return True if the cases
+        changed."""
+        if cases is self.cases or (cases is not None and
+                                   self.cases is not None and
+                                   np.array_equal(cases, self.cases)):
+            return False
+        if self.cases is None:
+            self.full_caches = self.train_memo, self.train_nodes
+        if cases is None:
+            self.train_X, self.train_y = self.all_train_X, self.all_train_y
+            self.train_memo, self.train_nodes = self.full_caches
+        else:
+            self.train_X = self.all_train_X[:, cases]
+            self.train_y = self.all_train_y[cases]
+            self.train_memo, self.train_nodes = self.new_memo(), None
+        self.cases = cases
+        return True
+
+    def describe_cases(self):
+        """Which training cases are in use, for the stats: all of
+        them, or how many, and their indices if there are up to 20,
+        else the lowest and highest index and a digest of them all,
+        which is the same whenever the same cases are used."""
+        n = len(self.all_train_y)
+        if self.cases is None:
+            return "all {0}".format(n)
+        cases = self.cases
+        if len(cases) <= 20:
+            return "{0} of {1} [{2}]".format(
+                len(cases), n, ",".join(str(i) for i in cases))
+        digest = hashlib.sha1(np.asarray(cases, dtype=np.int64).tobytes())
+        return "{0} of {1} [{2}..{3}] sha1 {4}".format(
+            len(cases), n, cases[0], cases[-1], digest.hexdigest()[:10])
 
+    def full_fitness(self, fn):
+        """Fitness on all the training cases, whatever set_cases has
+        chosen."""
+        cases = self.cases
+        if cases is None:
+            return self(fn)
+        X, y = self.train_X, self.train_y
+        memo, nodes = self.train_memo, self.train_nodes
+        self.set_cases(None)
+        try:
+            return self(fn)
+        finally:
+            self.full_caches = self.train_memo, self.train_nodes
+            self.train_X, self.train_y = X, y
+            self.train_memo, self.train_nodes = memo, nodes
+            self.cases = cases
 
     @classmethod
     def init_from_data_file(cls, filename, split=0.9,
-                            randomise=False, defn="rmse"):
-        """Construct an SRFF by reading data from a file. Split the
-        data according to split, eg 0.9 means 90% for training, 10%
-        for testing. If randomise is True, take random rows; else take
-        the last rows as test data. TODO: allow more flexibile
-        test/train splits?"""
-        d = np.genfromtxt(filename)
-        if randomise:
-            # this shuffles the rows
-            np.random.shuffle(d)
-        dX = d[:,:-1]
-        dy = d[:,-1]
+                            randomise=False, defn="rmse", seed=None):
+        """Construct an SRFF by reading data from a file (see
+        load_data_file). Split the data according to split, eg 0.9
+        means 90% for training, 10% for testing. If randomise is True,
+        take random rows, in an order shuffled by a RandomState seeded
+        with seed, or by np.random if seed is None; else take the last
+        rows as test data. Unshuffled, the training and testing data
+        are views of the file; shuffled, they are copied from it by
+        index, without copying the whole file first. TODO: allow more
+        flexibile test/train splits?"""
+        d = load_data_file(filename)
         idx = int(split * len(d))
-        train_X = dX[:idx].T
-        train_y = dy[:idx]
-        test_X = dX[idx:].T
-        test_y = dy[idx:]
+        if randomise:
+            rng = np.random if seed is None else np.random.RandomState(seed)
+            order = rng.permutation(len(d))
+            train, test = d[order[:idx]], d[order[idx:]]
+        else:
+            train, test = d[:idx], d[idx:]
+        train_X = train[:,:-1].T
+        train_y = train[:,-1]
+        test_X = test[:,:-1].T
+        test_y = test[:,-1]
         print("shapes", train_X.shape, train_y.shape, test_X.shape, test_y.shape)
         return SymbolicRegressionFitnessFunction(train_X, train_y,
                                                  test_X, test_y, defn)
@@ -263,16 +576,16 @@ class SymbolicRegressionFitnessFunction:
         within a small threshold)."""
 
         # Training data
-        cases = cls.build_column_mesh_np(cls.build_cases(**train))
+        cases = cls.build_cases(**train)
         values = target(cases)
 
         # Testing data -- FIXME this could be neater.
         if test1 and test2:
-            testing_cases = cls.build_column_mesh_np(cls.build_cases(**test1) + 
-                                                           cls.build_cases(**test2))
+            testing_cases = np.hstack((cls.build_cases(**test1),
+                                       cls.build_cases(**test2)))
             testing_values = target(testing_cases)
         elif test1:
-            testing_cases = cls.build_column_mesh_np(cls.build_cases(**test1))
+            testing_cases = cls.build_cases(**test1)
             testing_values = target(testing_cases)
         else:
             # No special testing cases -- use training cases
@@ -292,24 +605,38 @@ class SymbolicRegressionFitnessFunction:
         """Run the function over the training set. Return the fitness
         and the vector of results (the "semantics" of the function).
         Return (default_fitness, None) on error. Pass test=True to run
-        the function over the testing set instead. TODO try
-        memoizing."""
+        the function over the testing set instead. If memoize() has
+        been called, results are looked up before being computed."""
+        memo = self.test_memo if test else self.train_memo
+        if memo is None:
+            return self.evaluate_semantics(fn, test)
+        key = phenotype_key(fn)
+        if key is None:
+            return self.evaluate_semantics(fn, test)
+        result = memo.get(key)
+        if result is None:
+            result = self.evaluate_semantics(fn, test)
+            memo.put(key, result)
+        return result
+
+    def evaluate_semantics(self, fn, test=False):
+        """As get_semantics, but without memoization."""
         if not callable(fn):
             # assume fn is a string which evals to a function.
             try:
-                fn = eval(fn)
+                fn = COMPILED.get(fn)
             except MemoryError:
                 return default_fitness(self.maximise), None
         try:
             if not test:
                 assert(self.train_y is not None)
-                vals_at_cases = fn(self.train_X)
+                vals_at_cases = COMPILED.run(fn, self.train_X)
                 assert(vals_at_cases is not None)
                 fit = self.defn(self.train_y, vals_at_cases)
                 return fit, vals_at_cases
             else:
                 assert(self.test_y is not None)
-                vals_at_cases = fn(self.test_X)
+                vals_at_cases = COMPILED.run(fn, self.test_X)
                 assert(vals_at_cases is not None)
                 fit = self.defn(self.test_y, vals_at_cases)
                 return fit, vals_at_cases
@@ -322,13 +649,106 @@ class SymbolicRegressionFitnessFunction:
             print("TypeError: " + str(te) +':' + str(fn))
             raise
 
+    def get_semantics_batch(self, fns, test=False):
+        """As get_semantics, but for a list of phenotypes, eg a whole
+        generation: return a list of (fitness, semantics). Phenotypes
+        which can be described as expressions (see phenotype_expr)
+        are evaluated node by node, with the value of every
+        subexpression kept in an LRU cache of roughly at most
+        node_cache_bytes. So a subexpression shared by many
+        individuals, in this batch or a recent one, is evaluated only
+        once. Other phenotypes are passed to get_semantics."""
+        if test:
+            X, y = self.test_X, self.test_y
+            if self.test_nodes is None:
+                self.test_nodes = cache.LRUCache(
+                    sys.maxint, maxbytes=self.node_cache_bytes,
+                    sizeof=node_size)
+            nodes, memo = self.test_nodes, self.test_memo
+        else:
+            X, y = self.train_X, self.train_y
+            if self.train_nodes is None:
+                self.train_nodes = cache.LRUCache(
+                    sys.maxint, maxbytes=self.node_cache_bytes,
+                    sizeof=node_size)
+            nodes, memo = self.train_nodes, self.train_memo
+        assert(y is not None)
+        results = []
+        for fn in fns:
+            key = phenotype_key(fn) if memo is not None else None
+            result = memo.get(key) if key is not None else None
+            if result is None:
+                expr = phenotype_expr(fn)
+                try:
+                    if expr is None:
+                        raise RuntimeError
+                    vals_at_cases = self.node_value(expr, X, nodes)
+                except RuntimeError:
+                    # maximum recursion depth exceeded, or no expr
+                    result = self.evaluate_semantics(fn, test)
+                else:
+                    result = self.semantics_fitness(y, vals_at_cases)
+                if key is not None:
+                    memo.put(key, result)
+            results.append(result)
+        return results
+
+    def semantics_fitness(self, y, vals_at_cases):
+        """Return the fitness and semantics of values computed by
+        node_value, as evaluate_semantics would."""
+        if vals_at_cases is FAILED:
+            return default_fitness(self.maximise), None
+        try:
+            return self.defn(y, vals_at_cases), vals_at_cases
+        except FloatingPointError:
+            return default_fitness(self.maximise), None
+
+    def node_value(self, expr, X, nodes):
+        """Evaluate expr over the cases X, looking up and storing the
+        values of its subexpressions in the cache nodes. Return FAILED
+        if a FloatingPointError makes the whole expression fail."""
+        value = nodes.get(expr)
+        if value is not None:
+            return value
+        name = expr[0]
+        if name == "x":
+            value = X[expr[1]]
+        elif name == "c":
+            value = expr[2]
+        elif name == "pdiv":
+            value = self.node_value(expr[1], X, nodes)
+            if value is not FAILED:
+                denominator = self.node_value(expr[2], X, nodes)
+                if denominator is not FAILED:
+                    try:
+                        value = divide(value, denominator)
+                    except FloatingPointError:
+                        pass
+        else:
+            args = [self.node_value(arg, X, nodes) for arg in expr[1:]]
+            if any(arg is FAILED for arg in args):
+                value = FAILED
+            else:
+                try:
+                    value = EXPR_FNS[name](*args)
+                except FloatingPointError:
+                    value = FAILED
+        nodes.put(expr, value)
+        return value
+
+    def fitness_batch(self, fns):
+        """Return just the fitness values for a list of phenotypes,
+        for use as variga.FITNESS_BATCH."""
+        return [fit for fit, vals in self.get_semantics_batch(fns)]
+
     def test(self, fn):
         """Test ind on unseen data. Return a fitness value."""
         return self.get_semantics(fn, True)[0]
 
     @staticmethod
     def build_cases(minv, maxv, incrv=None, randomx=None, ncases=None):
-        """Generate fitness cases, either randomly or in a mesh."""
+        """Generate fitness cases, either randomly or in a mesh, as an
+        array with one row per variable and one column per case."""
         if randomx is True:
             # incrv is ignored
             return SymbolicRegressionFitnessFunction.build_random_cases(minv, maxv, ncases)
@@ -368,17 +788,19 @@ class SymbolicRegressionFitnessFunction:
 
     @staticmethod
     def build_random_cases(minv, maxv, n):
-        """Create a list of n lists, each list being x-coordinates for a
-        fitness case. Generate them randomly within the bounds given by
-        minv and maxv."""
-        return [[random.uniform(lb, ub) for lb, ub in zip(minv, maxv)]
-                for i in range(n)]
+        """Create an array of n fitness cases, one row per variable and
+        one column per case, as build_column_mesh_np would. Generate
+        them uniformly at random (using np.random) within the bounds
+        given by minv and maxv."""
+        lb = np.array(minv, dtype=float)[:, np.newaxis]
+        ub = np.array(maxv, dtype=float)[:, np.newaxis]
+        return lb + (ub - lb) * np.random.random((len(lb), n))
 
     @staticmethod
     def build_mesh(minv, maxv, increment):
         """Build a mesh, i.e. enumerate all points within the volume
         specified by the minv and maxv lists, at increment distances
-        apart. Uses itertools.product.
+        apart, in the order itertools.product would give them.
 
         Two constraints on the input parameters: The three lists provided
         as parameters should be of the same length; and minv[i] <= maxv[i]
@@ -390,8 +812,10 @@ class SymbolicRegressionFitnessFunction:
         @param minv A list of minimum values for the n variables.
         @param maxv A list of maximum values for the n variables.
         @param increment A list of increments for the n variables.
-        @return A list of tuples. Each tuple is the coordinates of a
-        particular point."""
+        @return An array with a row for each variable and a column for
+        each point, as build_column_mesh_np would give. Each value is
+        calculated as minv[i] + increment[i] * step, so the endpoints
+        are exactly as they were with lists: see test_build_mesh."""
 
         assert len(minv) == len(maxv) == len(increment)
         one_d_meshes = []
@@ -399,10 +823,10 @@ class SymbolicRegressionFitnessFunction:
             assert minvi <= maxvi
             nsteps = int((maxvi - minvi) / float(inci)) # eg [0, 10, 1] gives 10
             # note +1 to reach max
-            mesh = [minvi + inci * i for i in range(nsteps + 1)]
+            mesh = minvi + inci * np.arange(nsteps + 1, dtype=float)
             one_d_meshes.append(mesh)
-        p = list(product(*one_d_meshes))
-        return p
+        grids = np.meshgrid(*one_d_meshes, indexing="ij")
+        return np.array([grid.ravel() for grid in grids])
 
     @staticmethod
     def test_build_random():
@@ -411,27 +835,30 @@ class SymbolicRegressionFitnessFunction:
         maxv = [2.0, 2.0]
         n = 100
         mesh = SymbolicRegressionFitnessFunction.build_random_cases(minv, maxv, n)
-        print(len(mesh))
-        for item in mesh:
-            print(item)
+        print(mesh.shape[1])
+        for item in mesh.T:
+            print(item.tolist())
 
     @staticmethod
     def test_build_mesh():
-        """Test -- this should print 63 points:
+        """Test -- this should print 63 points, with the usual
+        floating-point error in some of them, eg:
         [0.0, 0.0]
         [0.0, 1.0]
         [0.0, 2.0]
         [...]
-        [2.0000000000000004, 0.0]
-        [2.0000000000000004, 1.0]
-        [2.0000000000000004, 2.0]"""
+        [0.30000000000000004, 0.0]
+        [...]
+        [2.0, 0.0]
+        [2.0, 1.0]
+        [2.0, 2.0]"""
         minv = [0.0, 0.0]
         maxv = [2.0, 2.0]
         incrv = [0.1, 1.0]
         mesh = SymbolicRegressionFitnessFunction.build_mesh(minv, maxv, incrv)
-        print(len(mesh))
-        for item in mesh:
-            print(item)
+        print(mesh.shape[1])
+        for item in mesh.T:
+            print(item.tolist())
 
     @staticmethod
     def build_column_mesh_np(in_mesh):
@@ -442,31 +869,112 @@ class SymbolicRegressionFitnessFunction:
         mesh = mesh.transpose()
         return mesh
 
+def read_data_file(filename):
+    """Read a whitespace-separated table of numbers, as np.genfromtxt
+    would. A complete numeric table is parsed in one call to
+    np.fromstring, much faster than genfromtxt; anything else, eg with
+    comments or missing values, falls back to genfromtxt."""
+    with open(filename) as f:
+        txt = f.read()
+    tokens = txt.split()
+    lines = [line for line in txt.splitlines() if line.strip()]
+    if lines:
+        ncols = len(lines[0].split())
+        if len(tokens) == ncols * len(lines):
+            d = np.fromstring(txt, sep=" ")
+            if d.size == len(tokens):
+                return d.reshape(len(lines), ncols).squeeze()
+    return np.genfromtxt(filename)
+
+def load_data_file(filename):
+    """Return the table in the text file filename (see read_data_file)
+    as a read-only memory-mapped array. The first time, the file is
+    parsed and saved as .npy next to it, named for the text file's
+    size and mtime, so a changed file is parsed again, and caches of
+    its earlier versions are deleted. If the cache can't be written,
+    just return the parsed array."""
+    st = os.stat(filename)
+    cached = "%s.%d.%d.npy" % (filename, st.st_size, int(st.st_mtime * 1000))
+    if not os.path.exists(cached):
+        d = read_data_file(filename)
+        try:
+            with open(cached + ".tmp", "wb") as f:
+                np.save(f, d)
+            os.rename(cached + ".tmp", cached)
+        except (IOError, OSError):
+            return d
+        pattern = re.compile(re.escape(filename) + r"\.\d+\.\d+\.npy$")
+        for old in glob.glob(glob_escape(filename) + ".*.npy"):
+            if old != cached and pattern.match(old):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass # eg removed by another process already
+    return np.load(cached, mmap_mode="r")
+
+def glob_escape(s):
+    """s with glob's special characters quoted (glob.escape is
+    Python 3 only)."""
+    return re.sub(r"([*?[])", r"[\1]", s)
+
+class BenchmarkRegistry(collections.Mapping):
+    """A dictionary of benchmark problems, which builds each one only
+    when it's first looked up, and then keeps it for the life of the
+    process. So we don't pay for reading data files, or building
+    meshes, for benchmarks we don't use."""
+    def __init__(self):
+        self.builders = collections.OrderedDict()
+        self.built = {}
+
+    def register(self, name, build):
+        """build() should return the benchmark."""
+        self.builders[name] = build
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            self.built[name] = self.builders[name]()
+        return self.built[name]
+
+    def __iter__(self):
+        return iter(self.builders)
+
+    def __len__(self):
+        return len(self.builders)
+
+BENCHMARKS = BenchmarkRegistry()
+
+BENCHMARKS.register("identity", lambda:
+    SymbolicRegressionFitnessFunction.init_from_target_fn(
+        lambda x: x,
+        {"minv": [0.0], "maxv": [1.0], "incrv": [0.1]}))
+
+BENCHMARKS.register("vladislavleva_12", lambda:
+    SymbolicRegressionFitnessFunction.init_from_target_fn(
+        lambda x: exp(-x[0]) * power(x[0], 3.0) * cos(x[0]) * sin(x[0]) \
+            * ((cos(x[0]) * power(sin(x[0]), 2.0)) - 1.0),
+        {"minv": [0.05], "maxv": [10.0], "incrv": [0.1]}))
+
+BENCHMARKS.register("pagie_2d", lambda:
+    SymbolicRegressionFitnessFunction.init_from_target_fn(
+        lambda x: (1 / (1 + x[0] ** -4) + 1 / (1 + x[1] ** -4)),
+        {"minv": [-5, -5], "maxv": [5, 5], "incrv": [0.4, 0.4]}))
+
+BENCHMARKS.register("pagie_3d", lambda:
+    SymbolicRegressionFitnessFunction.init_from_target_fn(
+        lambda x: (1 / (1 + x[0] ** -4) + 1 / (1 + x[1] ** -4)
+                   + 1 / (1 + x[2] ** -4)),
+        {"minv": [-5, -5, -5], "maxv": [5, 5, 5], "incrv": [0.4, 0.4, 0.4]}))
+
+BENCHMARKS.register("vanneschi_bioavailability", lambda:
+    SymbolicRegressionFitnessFunction.init_from_data_file(
+        "../data/bioavailability.txt", split=0.7, randomise=True,
+        seed=0))
+
 def benchmarks():
-    return {
-        "identity": SymbolicRegressionFitnessFunction.init_from_target_fn(
-            lambda x: x,
-            {"minv": [0.0], "maxv": [1.0], "incrv": [0.1]}),
-        
-        "vladislavleva_12": SymbolicRegressionFitnessFunction.init_from_target_fn(
-            lambda x: exp(-x[0]) * power(x[0], 3.0) * cos(x[0]) * sin(x[0]) \
-                * ((cos(x[0]) * power(sin(x[0]), 2.0)) - 1.0),
-            {"minv": [0.05], "maxv": [10.0], "incrv": [0.1]}),
-
-        "pagie_2d": SymbolicRegressionFitnessFunction.init_from_target_fn(
-            lambda x: (1 / (1 + x[0] ** -4) + 1 / (1 + x[1] ** -4)),
-            {"minv": [-5, -5], "maxv": [5, 5], "incrv": [0.4, 0.4]}),
-
-        "pagie_3d": SymbolicRegressionFitnessFunction.init_from_target_fn(
-            lambda x: (1 / (1 + x[0] ** -4) + 1 / (1 + x[1] ** -4)
-                       + 1 / (1 + x[2] ** -4)),
-            {"minv": [-5, -5, -5], "maxv": [5, 5, 5], "incrv": [0.4, 0.4, 0.4]}),
-        "vanneschi_bioavailability":
-            SymbolicRegressionFitnessFunction.init_from_data_file(
-            "../data/bioavailability.txt", split=0.7, randomise=True)
-        }
+    """The benchmark registry: look up a benchmark by name, and it's
+    built the first time."""
+    return BENCHMARKS
 
-    
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         print("Usage: fitness.py <keyword>.")
@@ -477,14 +985,21 @@ if __name__ == "__main__":
         fn2 = "lambda x: True" # matches e5p for 16 cases out of 32
         fn3 = "lambda x: x[0] ^ x[1] ^ x[2] ^ x[3] ^ x[4]" # never matches e5p
 
-        b = BooleanProblem(5, eval(fn1)) # target is e5p itself
-        print(b(fn1)) # fitness = 0
-        print(b(fn2)) # fitness = 16
-        print(b(fn3)) # fitness = 32
+        for packed in [False, True]:
+            b = BooleanProblem(5, eval(fn1), packed) # target is e5p itself
+            print(b(fn1)) # fitness = 0
+            print(b(fn2)) # fitness = 16
+            print(b(fn3)) # fitness = 32
+
+            # Can also pass in a list of target values, ie semantics phenotype
+            b = BooleanProblem(2, [False, False, False, False], packed)
+            print(b(fn2))
 
-        # Can also pass in a list of target values, ie semantics phenotype
-        b = BooleanProblem(2, [False, False, False, False])
-        print(b(fn2))
+        # even-20 parity is only practical when packed
+        fn4 = "lambda x: ~logical_xor.reduce(x)"
+        b = BooleanProblem(20, eval(fn4), True)
+        print(b(fn4)) # fitness = 0
+        print(b(fn2)) # fitness = 524288
 
     elif sys.argv[1] == "test_random":
         fn1 = "dummy"
@@ -522,6 +1037,6 @@ if __name__ == "__main__":
         print(sr(g))
         
     elif sys.argv[1] == "test_sr_mesh":
-        test_build_mesh()
+        SymbolicRegressionFitnessFunction.test_build_mesh()
     elif sys.argv[1] == "test_sr_random":
-        test_build_random()
+        SymbolicRegressionFitnessFunction.test_build_random()
@@ -73,8 +73,9 @@ def traverse(t, path=None):
 grammar = Grammar("grammars/sr_2d_ne_test.bnf")
 srff = fitness.benchmarks()["pagie_2d"]
 MAX_CODON = 127
+MAX_DEPTH = None # eg 10 to reject deeper derivations without using up the genome
 def generate(random):
-    return random_str_mod(random, grammar)
+    return grammar.derive(random, MAX_CODON, max_depth=MAX_DEPTH)
 def success(err):
     return False # let's just keep running so all runs are same length
 variga.GENERATE = generate
@@ -90,4 +91,6 @@ variga.MAXIMISE = False
 variga.ELITE = 1
 variga.TOURNAMENT_SIZE = 3
 variga.WRAPS = 1
+variga.NEUTRAL_SKIP = True
+variga.REPORTS = [fitness.COMPILED.report]
 variga.main()
@@ -5,19 +5,67 @@
 # Hereby licensed under the GNU GPL v3.
 # http://ponyge.googlecode.com
 
-import sys, copy, re, random, math, operator
+import sys, os, copy, re, random, math, operator, hashlib
+import cPickle as pickle
+
+INF = float("inf")
+# Part of the cache file name: change it whenever the attributes which
+# read_bnf_file(), compile() or analyse() set change, so old caches
+# are ignored.
+CACHE_VERSION = 1
+
+def remove_stale_caches(file_name, cached):
+    """Delete the caches of file_name's earlier contents, or made by
+    an earlier CACHE_VERSION, all but cached."""
+    directory, base = os.path.split(file_name)
+    pattern = re.compile(re.escape(base) + r"\.[0-9a-f]+\.v\d+\.pickle$")
+    for name in os.listdir(directory or "."):
+        path = os.path.join(directory, name)
+        if pattern.match(name) and path != cached:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # eg removed by another process already
 
 class Grammar(object):
     """Context Free Grammar"""
     NT = "NT" # Non Terminal
     T = "T" # Terminal
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, cache=True):
+        """Read the grammar in file_name. If cache is True, the parsed
+        and compiled grammar is pickled next to the file the first
+        time, named for a hash of its contents, and later just loaded
+        from there. Caches of the file's earlier contents are deleted.
+        A Grammar pickles, so it can also be sent to worker processes
+        ready-made."""
+        if cache:
+            with open(file_name, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            cached = "%s.%s.v%d.pickle" % (file_name, digest[:16],
+                                           CACHE_VERSION)
+            try:
+                with open(cached, "rb") as f:
+                    self.__dict__.update(pickle.load(f))
+                return
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+
         self.rules = {}
         self.non_terminals, self.terminals = set(), set()
         self.start_rule = None
 
         self.read_bnf_file(file_name)
+        self.compile()
+
+        if cache:
+            try:
+                with open(cached + ".tmp", "wb") as f:
+                    pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(cached + ".tmp", cached)
+            except (IOError, OSError):
+                return # can't write the cache: no matter
+            remove_stale_caches(file_name, cached)
 
     def read_bnf_file(self, file_name):
         """Read a grammar file in BNF format"""
@@ -68,6 +116,236 @@ class Grammar(object):
                 else:
                     raise ValueError("Each rule must be on one line")
 
+    def compile(self):
+        """Build integer-indexed tables of the rules, for derive().
+        Non-terminals are numbered from 0 in order of definition, and
+        terminals are stored as negative numbers, ~i for
+        self.terminal_strings[i]. self.productions[nt] lists the
+        productions of non-terminal nt, each a tuple of symbol
+        numbers, reversed, ready to be pushed onto derive()'s stack.
+        As in ge.random_str_mod, any symbol which is a terminal is
+        treated as one."""
+        self.nt_names = list(self.rules.keys())
+        nt_index = dict((nt, i) for i, nt in enumerate(self.nt_names))
+        self.terminal_strings = sorted(self.terminals)
+        t_index = dict((t, i) for i, t in enumerate(self.terminal_strings))
+        def code(symbol):
+            if symbol in t_index:
+                return ~t_index[symbol]
+            if symbol not in nt_index:
+                # undefined: an error if derive() reaches it
+                nt_index[symbol] = len(self.nt_names)
+                self.nt_names.append(symbol)
+            return nt_index[symbol]
+        productions = dict(
+            (nt_index[nt], [tuple(code(symbol)
+                                  for symbol, kind in reversed(production))
+                            for production in self.rules[nt]])
+            for nt in self.rules)
+        self.productions = [productions.get(i)
+                            for i in range(len(self.nt_names))]
+        self.start_index = nt_index[self.start_rule[0]]
+        self.analyse()
+
+    def analyse(self):
+        """Work out, from the compiled tables, which derivations can
+        terminate and how soon. The depth of a derivation tree counts
+        non-terminal levels, so an NT with an all-terminal production
+        has min_depth 1. For each NT name:
+
+        min_depth[nt]: the least depth of any complete derivation from
+        nt, or INF if there is none (eg an undefined NT).
+        production_min_depth[nt]: the same for each of its productions.
+        reachable[nt]: the set of NTs which can appear anywhere below
+        nt, in one or more steps.
+        recursive[nt]: whether nt can appear below itself.
+        production_recursive[nt]: for each production, whether it
+        contains nt, or an NT which can lead back to it.
+
+        Also sets unreachable, the NTs which the start rule never
+        leads to, and nonterminating, the NTs with min_depth INF.
+        derive() uses the depths to cut off runaway derivations early:
+        see max_depth there."""
+        nts = range(len(self.nt_names))
+        productions = self.productions
+        # Bellman-Ford style: relax until nothing changes
+        depth = [INF] * len(nts)
+        changed = True
+        while changed:
+            changed = False
+            for i in nts:
+                for production in productions[i] or []:
+                    d = 1 + max([depth[s] for s in production if s >= 0] or [0])
+                    if d < depth[i]:
+                        depth[i] = d
+                        changed = True
+        self.production_depths = [
+            None if productions[i] is None else
+            [1 + max([depth[s] for s in production if s >= 0] or [0])
+             for production in productions[i]]
+            for i in nts]
+        # transitive closure of "appears in a production of"
+        children = [set(s for production in productions[i] or []
+                        for s in production if s >= 0) for i in nts]
+        reach = []
+        for i in nts:
+            seen, todo = set(), list(children[i])
+            while todo:
+                j = todo.pop()
+                if j not in seen:
+                    seen.add(j)
+                    todo.extend(children[j])
+            reach.append(seen)
+
+        names = self.nt_names
+        self.min_depth = dict((names[i], depth[i]) for i in nts)
+        self.production_min_depth = dict(
+            (names[i], self.production_depths[i]) for i in nts
+            if productions[i] is not None)
+        self.reachable = dict((names[i], set(names[j] for j in reach[i]))
+                              for i in nts)
+        self.recursive = dict((names[i], i in reach[i]) for i in nts)
+        self.production_recursive = dict(
+            (names[i], [any(s == i or (s >= 0 and i in reach[s])
+                            for s in production)
+                        for production in productions[i]])
+            for i in nts if productions[i] is not None)
+        start = self.start_index
+        self.unreachable = set(names[i] for i in nts
+                               if i != start and i not in reach[start])
+        self.nonterminating = set(names[i] for i in nts if depth[i] == INF)
+
+    def derive(self, nr, max_codon=127, tree=False, max_depth=None):
+        """Map the genome behind nr, a nonrandom.NonRandom, to a
+        phenotype string with the GE mod rule, exactly as
+        ge.random_str_mod does: whenever a non-terminal with more than
+        one production is expanded, leftmost first, the next codon,
+        an int in [0, max_codon], modulo the number of productions
+        chooses one. Iterative and table-driven, so it's much faster,
+        and there's no recursion limit. For an ArrayNonRandom the
+        codons are read straight from its list. Raises StopIteration,
+        and sets nr.used, as NonRandom does when the genome runs out.
+        If tree is True, return the string and the derivation tree, as
+        made by ge.random_dt_mod.
+
+        If max_depth is given, raise StopIteration as soon as a codon
+        chooses a production which can't be finished within that
+        depth (see analyse()), without reading any more codons, so
+        runaway derivations fail early. Those which finish are the
+        same as without max_depth."""
+        if tree:
+            return self.derive_tree(nr, max_codon, max_depth)
+        if max_depth is not None:
+            return self.derive_bounded(nr, max_depth, max_codon)
+        productions = self.productions
+        terminals = self.terminal_strings
+        codons = getattr(nr, "codons", None)
+        if codons is not None:
+            n, limit, used, maxval = nr.n, nr.limit, nr.used, nr.maxval
+        width = max_codon + 1
+        out = []
+        append = out.append
+        stack = [self.start_index]
+        push, pop = stack.extend, stack.pop
+        while stack:
+            symbol = pop()
+            if symbol < 0:
+                append(terminals[~symbol])
+                continue
+            choices = productions[symbol]
+            if choices is None:
+                raise KeyError(self.nt_names[symbol])
+            if len(choices) == 1:
+                push(choices[0])
+            elif codons is None:
+                push(choices[nr.randint(0, max_codon) % len(choices)])
+            else:
+                if used >= limit:
+                    nr.used = used + 1
+                    raise StopIteration
+                push(choices[int(codons[used % n] / maxval * width)
+                             % len(choices)])
+                used += 1
+        if codons is not None:
+            nr.used = used
+        return "".join(out)
+
+    def derive_bounded(self, nr, max_depth, max_codon=127):
+        """As derive(nr, max_codon, max_depth=max_depth). The stack
+        holds (symbol, depth) pairs, which the usual case can do
+        without."""
+        productions = self.productions
+        depths = self.production_depths
+        terminals = self.terminal_strings
+        codons = getattr(nr, "codons", None)
+        if codons is not None:
+            n, limit, used, maxval = nr.n, nr.limit, nr.used, nr.maxval
+        width = max_codon + 1
+        out = []
+        append = out.append
+        stack = [(self.start_index, 1)]
+        push, pop = stack.extend, stack.pop
+        while stack:
+            symbol, depth = pop()
+            if symbol < 0:
+                append(terminals[~symbol])
+                continue
+            choices = productions[symbol]
+            if choices is None:
+                raise KeyError(self.nt_names[symbol])
+            if len(choices) == 1:
+                i = 0
+            elif codons is None:
+                i = nr.randint(0, max_codon) % len(choices)
+            else:
+                if used >= limit:
+                    nr.used = used + 1
+                    raise StopIteration
+                i = int(codons[used % n] / maxval * width) % len(choices)
+                used += 1
+            if depth - 1 + depths[symbol][i] > max_depth:
+                if codons is not None:
+                    nr.used = used
+                raise StopIteration
+            depth += 1
+            push([(s, depth) for s in choices[i]])
+        if codons is not None:
+            nr.used = used
+        return "".join(out)
+
+    def derive_tree(self, nr, max_codon=127, max_depth=None):
+        """As derive(nr, max_codon, tree=True, max_depth=max_depth), a
+        separate loop so the usual case needn't build the tree. Reads
+        codons with nr.randint()."""
+        productions = self.productions
+        depths = self.production_depths
+        terminals = self.terminal_strings
+        out = []
+        dt = [self.nt_names[self.start_index]]
+        stack = [(self.start_index, dt, 1)]
+        while stack:
+            symbol, node, depth = stack.pop()
+            if symbol < 0:
+                out.append(node)
+                continue
+            choices = productions[symbol]
+            if choices is None:
+                raise KeyError(self.nt_names[symbol])
+            if len(choices) == 1:
+                i = 0
+            else:
+                i = nr.randint(0, max_codon) % len(choices)
+            if (max_depth is not None and
+                depth - 1 + depths[symbol][i] > max_depth):
+                raise StopIteration
+            production = choices[i]
+            children = [terminals[~s] if s < 0 else [self.nt_names[s]]
+                        for s in production]
+            node.extend(reversed(children))
+            stack.extend((s, c, depth + 1)
+                         for s, c in zip(production, children))
+        return "".join(out), dt
+
     def __str__(self):
         return "%s %s %s %s" % (self.terminals, self.non_terminals,
                                 self.rules, self.start_rule)
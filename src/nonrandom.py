@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import random, sys, itertools
+from math import ceil, log
+import numpy as np
 
 class NonRandom(random.Random):
     """This is a class derived from and implementing the same
@@ -61,7 +63,120 @@ class NonRandom(random.Random):
         self.used += 1
         return next(self.it) / self.maxval
 
+class ArrayNonRandom(NonRandom):
+    """A faster drop-in replacement for NonRandom, for when the genome
+    is a sequence (a list, array or numpy array) rather than an
+    arbitrary iterator. Wraps are handled by index arithmetic instead
+    of copying the genome, and each codon is only divided by maxval
+    when it's read, since mappings often read only a few. used and
+    StopIteration behave exactly as in NonRandom.
+
+    randint, choice, shuffle and sample are overridden to read the
+    codons directly instead of calling random() each time. They give
+    the same results as the Python 2 random.Random methods, given
+    integer arguments."""
+
+    def __init__(self, it, maxval=sys.maxint, wraps=0):
+        self.maxval = float(maxval)
+        # Indexing a list is much faster than indexing an ndarray.
+        self.codons = it.tolist() if hasattr(it, "tolist") else it
+        self.n = len(self.codons)
+        self.limit = self.n * (wraps + 1)
+        self.used = 0
+
+    def random(self):
+        i = self.used
+        self.used = i + 1
+        if i >= self.limit:
+            raise StopIteration
+        return self.codons[i % self.n] / self.maxval
+
+    def randint(self, a, b):
+        width = b - a + 1
+        if not 0 < width < MAXWIDTH:
+            # let random.Random raise the error, or deal with huge ranges
+            return NonRandom.randint(self, a, b)
+        i = self.used
+        self.used = i + 1
+        if i >= self.limit:
+            raise StopIteration
+        return a + int(self.codons[i % self.n] / self.maxval * width)
+
+    def choice(self, seq):
+        i = self.used
+        self.used = i + 1
+        if i >= self.limit:
+            raise StopIteration
+        return seq[int(self.codons[i % self.n] / self.maxval * len(seq))]
+
+    def shuffle(self, x, random=None):
+        if random is not None:
+            return NonRandom.shuffle(self, x, random)
+        codons, maxval = self.codons, self.maxval
+        n, limit, used = self.n, self.limit, self.used
+        for i in reversed(range(1, len(x))):
+            if used >= limit:
+                self.used = used + 1
+                raise StopIteration
+            j = int(codons[used % n] / maxval * (i + 1))
+            used += 1
+            x[i], x[j] = x[j], x[i]
+        self.used = used
+
+    def sample(self, population, k):
+        npop = len(population)
+        setsize = 21
+        if k > 5:
+            setsize += 4 ** ceil(log(k * 3, 4))
+        if not 0 <= k <= npop or npop > setsize or hasattr(population, "keys"):
+            # the set-based method for small samples of large
+            # populations, and errors: leave them to random.Random
+            return NonRandom.sample(self, population, k)
+        codons, maxval = self.codons, self.maxval
+        n, limit, used = self.n, self.limit, self.used
+        result = [None] * k
+        pool = list(population)
+        for i in range(k):
+            if used >= limit:
+                self.used = used + 1
+                raise StopIteration
+            j = int(codons[used % n] / maxval * (npop - i))
+            used += 1
+            result[i] = pool[j]
+            pool[j] = pool[npop - i - 1]
+        self.used = used
+        return result
+
+# random.Random uses random() only for ranges narrower than this
+MAXWIDTH = 1 << 53
+
+def benchmark(reps=2000):
+    """Time the use of a 100-codon genome: build the object, then
+    read codons. "ge" reads 10 codons with randint, about as many as
+    ge.py's mappings use (see its used_codons stats); "heavy" reads
+    150, then uses choice, sample and shuffle."""
+    import timeit
+    genome = [random.randint(0, sys.maxint - 1) for i in range(100)]
+    def ge(r):
+        for i in range(10):
+            r.randint(0, 127)
+    def heavy(r):
+        for i in range(150):
+            r.randint(0, 127)
+        r.choice("abcde")
+        r.sample(range(10), 4)
+        r.shuffle(list(range(20)))
+    for name, use in ("ge", ge), ("heavy", heavy):
+        for cls in NonRandom, ArrayNonRandom:
+            t = timeit.timeit(lambda: use(cls(genome, wraps=1)), number=reps)
+            print("%s, %s: %.1f us per genome" % (
+                    name, cls.__name__, 1e6 * t / reps))
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+        sys.exit()
+
     def use_random():
         print(random.random())
         print(random.random())
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 
-import sys, time, random
+import sys, time, random, struct
 import numpy as np
 import nonrandom
 from copy import deepcopy
 from variga import xover
 
 (fitness_idx, used_idx, genome_idx, phenotype_idx,
- semantics_idx) = range(5)
+ semantics_idx, prepared_idx) = range(6)
+
+# If set, PHENOTYPE_PREPARE(phenotype) is computed once per individual,
+# and passed to PHENOTYPE_DISTANCE instead of the phenotype, eg to
+# precompute tree traversals.
+PHENOTYPE_PREPARE = None
 
 def IndividualWithSemantics(genome):
     if genome is None:
         LEN = random.randint(MINLEN, MAXLEN)
         genome = [random.randint(0, MAXV-1) for i in range(LEN)]
-    nr = nonrandom.NonRandom(genome, maxval=MAXV, wraps=WRAPS)
+    nr = nonrandom.ArrayNonRandom(genome, maxval=MAXV, wraps=WRAPS)
     try:
         # FIXME unfortunately this scheme is specific to trees
         # generated with grow or bubble-down, at least so far. Other
@@ -30,7 +35,11 @@ def IndividualWithSemantics(genome):
         else:
             fitness = float("inf")
     used = nr.used
-    return (fitness, used, genome, phenotype, semantics)
+    if phenotype is None or PHENOTYPE_PREPARE is None:
+        prepared = phenotype
+    else:
+        prepared = PHENOTYPE_PREPARE(phenotype)
+    return (fitness, used, genome, phenotype, semantics, prepared)
 
 
 # note xover takes parent inds and returns genomes
@@ -92,11 +101,111 @@ def generate_crossover_pairs(n):
 def distances(g, h):
     # g and h are individuals
     return (levenshtein(g[genome_idx], h[genome_idx]),
-            PHENOTYPE_DISTANCE(g[phenotype_idx], h[phenotype_idx]),
+            PHENOTYPE_DISTANCE(g[prepared_idx], h[prepared_idx]),
             SEMANTIC_DISTANCE(g[semantics_idx], h[semantics_idx]),
             abs(g[fitness_idx] - h[fitness_idx]))
 
-def levenshtein(a,b):
+# One row of a binary distances file: the values distances() returns.
+DISTANCES_DTYPE = np.dtype([("genotype", "<i8"), ("phenotype", "<i8"),
+                            ("semantics", "<f8"), ("fitness", "<f8")])
+
+# Total size of the .npy header DistanceWriter writes, a multiple of
+# 64 so the data is aligned when memory-mapped.
+NPY_HEADER_LEN = 192
+
+class DistanceWriter(object):
+    """Writes rows of distances, as given by distances(), to filename:
+    as text lines "%d %d %f %f", or if binary, as a .npy file holding
+    a structured array of DISTANCES_DTYPE, which np.load can
+    memory-map without any parsing. The number of rows isn't known
+    until the end, so the .npy header is written with a placeholder,
+    padded to a fixed length, and rewritten by close()."""
+
+    def __init__(self, filename, binary=False):
+        self.binary = binary
+        self.nrows = 0
+        self.f = open(filename, "wb" if binary else "w")
+        if binary:
+            self.write_header()
+
+    def write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            np.lib.format.dtype_to_descr(DISTANCES_DTYPE), self.nrows)
+        preamble = (np.lib.format.magic(1, 0) +
+                    struct.pack("<H", NPY_HEADER_LEN - 10)) # little-endian
+        header = header.ljust(NPY_HEADER_LEN - len(preamble) - 1) + "\n"
+        assert len(preamble) + len(header) == NPY_HEADER_LEN
+        self.f.seek(0)
+        self.f.write(preamble + header)
+
+    def write_rows(self, rows):
+        self.nrows += len(rows)
+        if self.binary:
+            self.f.write(np.array(rows, dtype=DISTANCES_DTYPE).tobytes())
+        else:
+            self.f.write("".join("%d %d %f %f\n" % row for row in rows))
+
+    def close(self):
+        if self.binary:
+            self.write_header()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def levenshtein(a, b, max_dist=None):
+    """Calculates the Levenshtein distance between a and b, sequences
+    of hashable items, eg genomes, using the bit-parallel algorithm of
+    Myers, in Hyyro's formulation: each column of the DP table is held
+    as bit-vectors of +1/-1 vertical differences, in one Python int,
+    so each item of b costs a few integer operations instead of a loop
+    over a. Gives the same results as levenshtein_dp. If max_dist is
+    given, gives up as soon as the distance must be greater than
+    max_dist, and returns max_dist + 1."""
+    if hasattr(a, "tolist"):
+        a = a.tolist()
+    if hasattr(b, "tolist"):
+        b = b.tolist()
+    n, m = len(a), len(b)
+    if n > m:
+        # Make sure n <= m, so the bit-vectors are as short as possible
+        a, b = b, a
+        n, m = m, n
+    if max_dist is not None and m - n > max_dist:
+        return max_dist + 1
+    if n == 0:
+        return m
+    # peq[x] has bit j set where a[j] == x
+    peq = {}
+    for j, x in enumerate(a):
+        peq[x] = peq.get(x, 0) | (1 << j)
+    full = (1 << n) - 1
+    last = 1 << (n - 1)
+    pv, mv = full, 0
+    score = n
+    for i, x in enumerate(b):
+        eq = peq.get(x, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+        # the score can fall by at most 1 per remaining item of b
+        if max_dist is not None and score - (m - i - 1) > max_dist:
+            return max_dist + 1
+    return score
+
+def levenshtein_dp(a,b):
     """Calculates the Levenshtein distance between a and b. Copied
     from [http://hetland.org/coding/python/levenshtein.py]"""
     n, m = len(a), len(b)
@@ -118,12 +227,9 @@ def levenshtein(a,b):
     return current[n]
 
 def hamming_distance(g, h):
-    # g and h are genomes
-    d = 0
-    for gi, hi in zip(g, h):
-        if gi != hi:
-            d += 1
-    return d
+    # g and h are genomes. Like zip, ignores the end of the longer one.
+    n = min(len(g), len(h))
+    return int(np.count_nonzero(np.asarray(g[:n]) != np.asarray(h[:n])))
     
 def main():
     from sys import argv
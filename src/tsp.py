@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import time
 import variga
 import numpy as np
 from math import sqrt
@@ -12,45 +15,229 @@ def overlapping_pairs(seq):
 def euclidean_distance(x, y):
     return sqrt(sum((xi - yi) ** 2.0 for xi, yi in zip(x, y)))
 
-class TSP:
-    def __init__(self, filename):
-        self.coords = {}
-        self.read_file(filename)
-        self.read_optimal_results("TSPLIB/all_optimal.txt")
+def nint(x):
+    """TSPLIB's nearest-integer rounding, (int) (x + 0.5)."""
+    return np.floor(x + 0.5).astype(np.int64)
 
-    def read_optimal_results(self, filename):
+def geo_radians(x):
+    """TSPLIB's conversion of a GEO coordinate, in DDD.MM degrees and
+    minutes, to radians."""
+    deg = np.trunc(x)
+    return 3.141592 * (deg + 5.0 * (x - deg) / 3.0) / 180.0
+
+def block_distances(a, b, edge_weight_type):
+    """Distances from each of the cities at coords a to each of those
+    at coords b, rounded according to the TSPLIB edge_weight_type, so
+    that tour lengths match TSPLIB's optimal results. EUC_2D rounds to
+    the nearest integer, CEIL_2D rounds up, ATT is the
+    pseudo-Euclidean distance used by eg att48, and GEO is the
+    distance in km on the idealised Earth. For None, plain unrounded
+    Euclidean distance."""
+    if edge_weight_type == "GEO":
+        lat_a = geo_radians(a[:, 0])[:, np.newaxis]
+        lon_a = geo_radians(a[:, 1])[:, np.newaxis]
+        lat_b, lon_b = geo_radians(b[:, 0]), geo_radians(b[:, 1])
+        q1 = np.cos(lon_a - lon_b)
+        q2 = np.cos(lat_a - lat_b)
+        q3 = np.cos(lat_a + lat_b)
+        c = np.clip(0.5 * ((1.0 + q1) * q2 - (1.0 - q1) * q3), -1.0, 1.0)
+        return (6378.388 * np.arccos(c) + 1.0).astype(np.int64)
+    diff = a[:, np.newaxis, :] - b[np.newaxis, :, :]
+    sqdist = (diff ** 2.0).sum(axis=2)
+    if edge_weight_type in ("EUC_2D", "EUC_3D"):
+        return nint(np.sqrt(sqdist))
+    elif edge_weight_type == "CEIL_2D":
+        return np.ceil(np.sqrt(sqdist)).astype(np.int64)
+    elif edge_weight_type == "ATT":
+        r = np.sqrt(sqdist / 10.0)
+        t = nint(r)
+        return np.where(t < r, t + 1, t)
+    elif edge_weight_type is None:
+        return np.sqrt(sqdist)
+    else:
+        raise ValueError("Unsupported EDGE_WEIGHT_TYPE " + edge_weight_type)
+
+def distance_matrix(xy, edge_weight_type=None, out=None):
+    """All the distances between the cities at coords xy (an n x 2 or
+    n x 3 array): see block_distances. Computed a block of rows at a
+    time, so large instances don't need n x n temporaries, into out if
+    given, eg a memory-mapped file."""
+    n = len(xy)
+    if out is None:
+        out = np.empty((n, n), dtype=distance_dtype(edge_weight_type))
+    for i in range(0, n, BLOCK):
+        out[i:i + BLOCK] = block_distances(xy[i:i + BLOCK], xy,
+                                           edge_weight_type)
+    return out
+
+def distance_dtype(edge_weight_type):
+    if edge_weight_type is None:
+        return np.float64
+    else:
+        return np.int32
+
+BLOCK = 256
+
+# For each EDGE_WEIGHT_FORMAT which gives a triangle of the matrix,
+# the numpy function and offset which list that triangle's indices in
+# the order the weights are given.
+TRIANGLES = {
+    "UPPER_ROW": (np.triu_indices, 1),
+    "LOWER_ROW": (np.tril_indices, -1),
+    "UPPER_DIAG_ROW": (np.triu_indices, 0),
+    "LOWER_DIAG_ROW": (np.tril_indices, 0),
+    "UPPER_COL": (np.tril_indices, -1),
+    "LOWER_COL": (np.triu_indices, 1),
+    "UPPER_DIAG_COL": (np.tril_indices, 0),
+    "LOWER_DIAG_COL": (np.triu_indices, 0)
+    }
+
+def explicit_matrix(weights, n, edge_weight_format):
+    """The distance matrix given by the list of weights from an
+    EDGE_WEIGHT_SECTION. Integer weights give an int32 matrix."""
+    w = np.array(weights, dtype=np.float64)
+    if edge_weight_format == "FULL_MATRIX":
+        D = w[:n * n].reshape(n, n)
+    elif edge_weight_format in TRIANGLES:
+        indices, k = TRIANGLES[edge_weight_format]
+        i, j = indices(n, k)
+        D = np.zeros((n, n))
+        D[i, j] = w[:len(i)]
+        D[j, i] = w[:len(i)]
+    else:
+        raise ValueError("Unsupported EDGE_WEIGHT_FORMAT " +
+                         str(edge_weight_format))
+    if np.all(D == np.round(D)):
+        D = D.astype(np.int32)
+    return D
+
+def neighbour_lists(D, k):
+    """For each city, the k nearest other cities, nearest first, as a
+    list of lists. Computed a block of rows at a time."""
+    n = len(D)
+    k = min(k, n - 1)
+    neighbours = []
+    for i in range(0, n, BLOCK):
+        rows = np.array(D[i:i + BLOCK], dtype=np.float64)
+        m = len(rows)
+        rows[np.arange(m), np.arange(i, i + m)] = np.inf # not itself
+        idx = np.argpartition(rows, k - 1, axis=1)[:, :k]
+        order = np.argsort(rows[np.arange(m)[:, np.newaxis], idx], axis=1)
+        neighbours.extend(idx[np.arange(m)[:, np.newaxis], order].tolist())
+    return neighbours
+
+def is_fresh(filename, source):
+    return (os.path.exists(filename) and
+            os.path.getmtime(filename) >= os.path.getmtime(source))
+
+# The contents of all_optimal.txt files, read once each.
+OPTIMAL_RESULTS = {}
+
+def read_optimal_results(filename):
+    if filename not in OPTIMAL_RESULTS:
         optimal_results = {}
         for line in open(filename).readlines():
             key, val = line.split(":")
             key = key.strip()
             # optimal results are given as integers in TSPLIB
-            val = int(val.split()[0].strip()) 
+            val = int(val.split()[0].strip())
             optimal_results[key] = val
         print(optimal_results)
-        self.optimal = optimal_results[self.name]
+        OPTIMAL_RESULTS[filename] = optimal_results
+    return OPTIMAL_RESULTS[filename]
+
+class TSP:
+    def __init__(self, filename):
+        self.load(filename)
+        self.read_optimal_results("TSPLIB/all_optimal.txt")
+        # local search parameters
+        self.k_neighbours = 8
+        self.max_moves = 1000
+        self.max_time = None # optional limit in seconds per tour
+        self.neighbours = None
+
+    def read_optimal_results(self, filename):
+        self.optimal = read_optimal_results(filename)[self.name]
+
+    def load(self, filename):
+        """Set the instance's name, n, and distance matrix D (indexed
+        from 0, where the cities are numbered from 1). The first time,
+        parse the file and save the results next to it, as .npz
+        (metadata) and .npy (the matrix). Afterwards, as long as they
+        are newer than the file, just load those, memory-mapping the
+        matrix, which is much faster for large instances."""
+        root = filename[:-3] if filename.endswith(".gz") else filename
+        npy, npz = root + ".npy", root + ".npz"
+        if is_fresh(npy, filename) and is_fresh(npz, filename):
+            with np.load(npz) as meta:
+                self.name = str(meta["name"])
+                self.edge_weight_type = str(meta["edge_weight_type"]) or None
+                self.n = int(meta["n"])
+            self.D = np.load(npy, mmap_mode="r")
+            return
+
+        self.read_file(filename)
+        try:
+            if self.xy is not None:
+                D = np.lib.format.open_memmap(
+                    npy + ".tmp", "w+",
+                    distance_dtype(self.edge_weight_type), (self.n, self.n))
+                distance_matrix(self.xy, self.edge_weight_type, D)
+                D.flush()
+                del D
+            else:
+                with open(npy + ".tmp", "wb") as f:
+                    np.save(f, self.D)
+            os.rename(npy + ".tmp", npy)
+            np.savez(npz, name=self.name, n=self.n,
+                     edge_weight_type=self.edge_weight_type or "")
+        except (IOError, OSError):
+            # can't write the cache: just work in memory
+            if self.xy is not None:
+                self.D = distance_matrix(self.xy, self.edge_weight_type)
+            return
+        self.D = np.load(npy, mmap_mode="r")
 
     def read_file(self, filename):
-        """FIXME this only works for files in the node xy-coordinate
-        format. Some files eg bayg29.tsp.gz give explicit edge weights
-        instead."""
-        f = gzip.open(filename, "rb")
-        coord_section = False
-        for line in f.readlines():
-            if line.startswith("NAME"):
-                self.name = line.split(":")[1].strip()
-            elif (line.startswith("COMMENT") or
-                  line.startswith("TYPE") or
-                  line.startswith("EDGE_WEIGHT_TYPE") or
-                  line.startswith("EOF")):
-                pass                  
-            elif line.startswith("DIMENSION"):
-                self.n = int(line.split(":")[1].strip())
-            elif line.startswith("NODE_COORD_SECTION"):
-                coord_section = True
-            elif coord_section:
+        """Parse a TSPLIB file: set name, n, edge_weight_type, and
+        either xy, the coords of the cities (from a
+        NODE_COORD_SECTION), or for EXPLICIT edge weights D, the
+        distance matrix (from an EDGE_WEIGHT_SECTION), with xy None.
+        Other sections, eg DISPLAY_DATA_SECTION, are skipped."""
+        spec = {}
+        section = None
+        coords = []
+        weights = []
+        for line in gzip.open(filename, "rb"):
+            line = line.strip()
+            if not line:
+                continue
+            elif line == "EOF":
+                break
+            elif line[0].isalpha():
+                key = line.split(":")[0].strip()
+                if key.endswith("_SECTION"):
+                    section = key
+                else:
+                    key, val = line.split(":", 1)
+                    spec[key.strip()] = val.strip()
+                    section = None
+            elif section == "NODE_COORD_SECTION":
                 # coords are sometimes given as floats in TSPLIB
-                idx, x, y = map(float, line.split(" "))
-                self.coords[idx] = x, y
+                coords.append([float(v) for v in line.split()])
+            elif section == "EDGE_WEIGHT_SECTION":
+                weights.extend(line.split())
+        self.name = spec["NAME"]
+        self.n = int(spec["DIMENSION"])
+        self.edge_weight_type = spec.get("EDGE_WEIGHT_TYPE")
+        if self.edge_weight_type == "EXPLICIT":
+            self.xy = None
+            self.D = explicit_matrix(weights, self.n,
+                                     spec.get("EDGE_WEIGHT_FORMAT"))
+        else:
+            coords = np.array(coords)
+            # sort by node number, then drop it
+            self.xy = coords[np.argsort(coords[:, 0], kind="mergesort"), 1:]
 
     def perm(self, random):
         s = range(1, self.n+1)
@@ -58,14 +245,145 @@ class TSP:
         return s
 
     def tour_length(self, tour):
-        return sum(self.dist(*pair)
-                   for pair in overlapping_pairs(tour) + [[tour[-1], tour[0]]])
+        t = np.asarray(tour) - 1
+        return self.D[t, np.roll(t, -1)].sum()
+
+    def tour_lengths(self, tours):
+        """Lengths of a whole population of tours at once, eg for
+        variga.FITNESS_BATCH."""
+        if len(tours) == 0:
+            return []
+        t = np.asarray(tours) - 1
+        return self.D[t, np.roll(t, -1, axis=1)].sum(axis=1)
+
+    def local_search(self, tour, fitness):
+        """Improve tour by 2-opt and Or-opt moves, for use as
+        variga.LOCAL_SEARCH. Each candidate move is scored in O(1)
+        from the distance matrix, and only moves which bring a city
+        next to one of its k_neighbours nearest cities are tried.
+        Stops at a local optimum, or after max_moves improving moves,
+        or after max_time seconds if that is set: that makes results
+        depend on the machine's speed and load, so it is None by
+        default. Return the improved tour and its length."""
+        n = len(tour)
+        if n < 5:
+            return tour, fitness
+        if self.neighbours is None:
+            self.neighbours = neighbour_lists(self.D, self.k_neighbours)
+        t = [c - 1 for c in tour]
+        pos = [0] * n
+        for i, c in enumerate(t):
+            pos[c] = i
+        deadline = None
+        if self.max_time is not None:
+            deadline = time.time() + self.max_time
+        moves = 0
+        improved = True
+        while improved:
+            improved = False
+            for a in range(n):
+                if moves >= self.max_moves or (
+                    deadline is not None and time.time() > deadline):
+                    improved = False
+                    break
+                if self.two_opt_move(t, pos, a) or self.or_opt_move(t, pos, a):
+                    moves += 1
+                    improved = True
+        if moves == 0:
+            return tour, fitness
+        tour = [c + 1 for c in t]
+        return tour, self.tour_length(tour)
+
+    def two_opt_move(self, t, pos, a):
+        """Look for a 2-opt move replacing the edges (a, b) and (c,
+        e), where b and e follow a and c in the tour t, with (a, c)
+        and (b, e). If one improves the tour, make it, updating the
+        positions pos, and return True."""
+        d = self.D.item
+        n = len(t)
+        i = pos[a]
+        b = t[(i + 1) % n]
+        dab = d(a, b)
+        for c in self.neighbours[a]:
+            dac = d(a, c)
+            if dac >= dab:
+                break
+            j = pos[c]
+            e = t[(j + 1) % n]
+            if c == b or e == a:
+                continue
+            if dac + d(b, e) - dab - d(c, e) < -EPSILON:
+                if i < j:
+                    reverse(t, pos, i + 1, j)
+                else:
+                    reverse(t, pos, j + 1, i)
+                return True
+        return False
+
+    def or_opt_move(self, t, pos, s1):
+        """Look for an Or-opt move taking the segment of 1 to 3 cities
+        starting at s1 out of the tour t and putting it back, maybe
+        reversed, next to one of s1's nearest cities. If one improves
+        the tour, make it, updating the positions pos, and return
+        True."""
+        d = self.D.item
+        n = len(t)
+        i = pos[s1]
+        p = t[i - 1]
+        for length in (1, 2, 3):
+            seg = [t[(i + k) % n] for k in range(length)]
+            s2 = seg[-1]
+            nx = t[(i + length) % n]
+            if nx == p:
+                break
+            gain = d(p, s1) + d(s2, nx) - d(p, nx)
+            for c in self.neighbours[s1]:
+                if d(s1, c) >= gain:
+                    break
+                if c in seg:
+                    continue
+                # c, s1 ... s2, e
+                e = t[(pos[c] + 1) % n]
+                if (e not in seg and
+                    d(c, s1) + d(s2, e) - d(c, e) - gain < -EPSILON):
+                    move_segment(t, pos, seg, c, False)
+                    return True
+                # f, s2 ... s1, c
+                f = t[pos[c] - 1]
+                if (f not in seg and
+                    d(f, s2) + d(s1, c) - d(f, c) - gain < -EPSILON):
+                    move_segment(t, pos, seg, c, True)
+                    return True
+        return False
 
     def success(self, fitness):
         return self.optimal >= fitness
 
     def dist(self, x, y):
-        return euclidean_distance(self.coords[x], self.coords[y])
+        return self.D[x - 1, y - 1]
+
+# Smallest improvement local search counts, so float distances can't
+# make it cycle.
+EPSILON = 1e-9
+
+def reverse(t, pos, i, j):
+    """Reverse t[i:j+1] in place, updating the positions pos."""
+    t[i:j + 1] = t[i:j + 1][::-1]
+    for k in range(i, j + 1):
+        pos[t[k]] = k
+
+def move_segment(t, pos, seg, c, before):
+    """Move the cities seg to just after c in the tour t, or if
+    before, reversed to just before c. Rebuilds the positions pos."""
+    rest = [x for x in t if x not in seg]
+    k = rest.index(c)
+    if before:
+        rest[k:k] = seg[::-1]
+    else:
+        rest[k + 1:k + 1] = seg
+    t[:] = rest
+    for k, x in enumerate(t):
+        pos[x] = k
 
 if __name__ == "__main__":
     problem = TSP("TSPLIB/att48.tsp.gz")
@@ -74,6 +392,9 @@ if __name__ == "__main__":
     # print(problem.tour_length(tour))
     variga.GENERATE = problem.perm
     variga.FITNESS = problem.tour_length
+    variga.FITNESS_BATCH = problem.tour_lengths
+    if "local_search" in sys.argv[1:]:
+        variga.LOCAL_SEARCH = problem.local_search
     variga.SUCCESS = problem.success
     variga.MAXIMISE = False
     variga.MINLEN = 200
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import sys, time, random
+import collections
+import multiprocessing
 import numpy as np
 import nonrandom
+import cache
 from copy import deepcopy
 
 fitness_idx, used_idx, genome_idx, phenotype_idx = range(4)
@@ -20,49 +23,298 @@ def ind_compare(x):
     else:
         return -x[fitness_idx]
 
+# With COMPACT, genomes are numpy uint32 arrays instead of lists of
+# ints, which takes several times less memory, and the codons are
+# drawn from np_random.
+def random_genome():
+    LEN = random.randint(MINLEN, MAXLEN)
+    if COMPACT:
+        return np_random.randint(0, MAXV, LEN, dtype=np.uint32)
+    return [random.randint(0, MAXV-1) for i in range(LEN)]
+
+def concatenate(g, h):
+    if COMPACT:
+        return np.concatenate((g, h))
+    return g + h
+
+def copy_genome(g):
+    if COMPACT:
+        return g.copy() # g[:] would be a view
+    return g[:]
+
+# A hashable key for a genome, or a slice of one.
+def genome_key(g):
+    if COMPACT:
+        return g.tobytes()
+    return tuple(g)
+
+# The evaluation cache, bounded by CACHE_SIZE entries and, if it's
+# set, roughly CACHE_BYTES bytes. Phenotypes are counted shallowly.
+def new_cache():
+    return cache.PrefixCache(CACHE_SIZE, genome_key, CACHE_BYTES,
+                             lambda value: (sys.getsizeof(value) +
+                                            sys.getsizeof(value[2])))
+
+def worst_fitness():
+    if MAXIMISE:
+        return -float("inf")
+    else:
+        return float("inf")
+
 def Individual(genome):
     if genome is None:
-        LEN = random.randint(MINLEN, MAXLEN)
-        genome = [random.randint(0, MAXV-1) for i in range(LEN)]
-    nr = nonrandom.NonRandom(genome, maxval=MAXV, wraps=WRAPS)
+        genome = random_genome()
+    nr = nonrandom.ArrayNonRandom(genome, maxval=MAXV, wraps=WRAPS)
     try:
         phenotype = GENERATE(nr)
         fitness = FITNESS(phenotype)
     except StopIteration:
         phenotype = None
-        if MAXIMISE:
-            fitness = -float("inf")
-        else:
-            fitness = float("inf")
+        fitness = worst_fitness()
     used = nr.used
     return (fitness, used, genome, phenotype)
 
+# Just the mapping part of Individual(): return used and the
+# phenotype, which is None if the genome ran out.
+def develop(genome):
+    nr = nonrandom.ArrayNonRandom(genome, maxval=MAXV, wraps=WRAPS)
+    try:
+        phenotype = GENERATE(nr)
+    except StopIteration:
+        phenotype = None
+    return nr.used, phenotype
+
+# Turn a list of genomes into a list of individuals, in the same
+# order. If CACHE_SIZE > 0, genomes which start with the same used
+# codons as an individual we've already made get its fitness and
+# phenotype without running GENERATE or FITNESS. Individuals which
+# wrapped or were invalid depend on the whole genome, so they're only
+# reused for an identical genome. Duplicates within the list are
+# evaluated once.
+def evaluate(genomes):
+    if CACHE is None:
+        return evaluate_uncached(genomes)
+    inds = [None] * len(genomes)
+    todo = collections.OrderedDict() # genome key -> indices
+    for i, g in enumerate(genomes):
+        hit = CACHE.get(g)
+        if hit is not None:
+            fitness, used, phenotype = hit
+            inds[i] = (fitness, used, g, phenotype)
+        else:
+            todo.setdefault(CACHE.key(g), []).append(i)
+    new = evaluate_uncached([genomes[idxs[0]] for idxs in todo.values()])
+    for ind, idxs in zip(new, todo.values()):
+        fitness, used, genome, phenotype = ind
+        if phenotype is not None and used <= len(genome):
+            CACHE.put(genome, used, (fitness, used, phenotype))
+        else:
+            CACHE.put(genome, None, (fitness, used, phenotype))
+        inds[idxs[0]] = ind
+        for i in idxs[1:]:
+            # a duplicate of a genome earlier in the list
+            CACHE.misses -= 1
+            CACHE.hits += 1
+            inds[i] = (fitness, used, genomes[i], phenotype)
+    return inds
+
+# Individual() only reads the genome and the problem parameters,
+# never the global random state, so sending chunks of genomes to the
+# worker pool gives the same individuals as a serial run. The pool is
+# only created if NPROCS > 1: see main().
+def evaluate_uncached(genomes):
+    if POOL is None:
+        return evaluate_chunk(genomes)
+    chunks = [genomes[i:i+CHUNKSIZE]
+              for i in range(0, len(genomes), CHUNKSIZE)]
+    if CASE_SCHEDULE != "full":
+        # the workers' FITNESS must use the same cases as ours
+        chunks = [(CASES, chunk) for chunk in chunks]
+        return [ind for chunk in POOL.map(evaluate_chunk_on_cases, chunks)
+                for ind in chunk]
+    return [ind for chunk in POOL.map(evaluate_chunk, chunks)
+            for ind in chunk]
+
+def evaluate_chunk_on_cases(args):
+    cases, genomes = args
+    FITNESS.set_cases(cases)
+    return evaluate_chunk(genomes)
+
+# If FITNESS_BATCH is set, all the valid phenotypes are passed to it
+# at once, and it returns a list of their fitness values.
+def evaluate_chunk(genomes):
+    if FITNESS_BATCH is None:
+        inds = [Individual(g) for g in genomes]
+    else:
+        developed = [develop(g) for g in genomes]
+        fits = iter(FITNESS_BATCH([phenotype for used, phenotype in developed
+                                   if phenotype is not None]))
+        inds = [(next(fits) if phenotype is not None else worst_fitness(),
+                 used, g, phenotype)
+                for g, (used, phenotype) in zip(genomes, developed)]
+    if LOCAL_SEARCH is not None:
+        inds = [improve(ind) for ind in inds]
+    return inds
+
+# The memetic stage: LOCAL_SEARCH(phenotype, fitness) returns an
+# improved phenotype and its fitness. The genome is left alone, so
+# the improvement is inherited only through selection.
+def improve(ind):
+    fitness, used, genome, phenotype = ind
+    if phenotype is None:
+        return ind
+    phenotype, fitness = LOCAL_SEARCH(phenotype, fitness)
+    return (fitness, used, genome, phenotype)
+
+# Re-run FITNESS (or FITNESS_BATCH) on the phenotypes of some
+# individuals, eg when the fitness cases have changed. Their genomes
+# needn't be mapped again.
+def rescore(inds):
+    phenotypes = [ind[phenotype_idx] for ind in inds
+                  if ind[phenotype_idx] is not None]
+    if FITNESS_BATCH is None:
+        fits = iter([FITNESS(p) for p in phenotypes])
+    else:
+        fits = iter(FITNESS_BATCH(phenotypes))
+    return [(next(fits), used, genome, phenotype)
+            if phenotype is not None else (fitness, used, genome, phenotype)
+            for fitness, used, genome, phenotype in inds]
+
+# With a CASE_SCHEDULE other than "full", each generation is evaluated
+# on the fitness cases which FITNESS.select_cases chooses for it, and
+# FITNESS.set_cases installs (see fitness.SymbolicRegressionFitnessFunction).
+# When they change, the evaluation cache is emptied, because the
+# fitness values in it no longer apply. Return True if they changed.
+def choose_cases(gen):
+    global CASES, CACHE
+    if CASE_SCHEDULE == "full":
+        return False
+    CASES = FITNESS.select_cases(gen, CASE_SCHEDULE, CASE_SAMPLE, np_random)
+    changed = FITNESS.set_cases(CASES)
+    if changed and CACHE is not None:
+        CACHE = new_cache()
+    return changed
+
+# With a CASE_SCHEDULE other than "full", a lucky individual can look
+# best on the current cases but not on all of them, so the elite are
+# chosen by FITNESS.full_fitness instead: the best on all the cases
+# among the last elite and the best ELITE of pop on the current cases.
+# ELITE_FULL keeps them, worst first, as (full fitness, individual)
+# pairs, so each is scored on all the cases only once.
+def full_elite(pop):
+    global ELITE_FULL
+    scored = list(ELITE_FULL)
+    seen = set(id(ind[genome_idx]) for f, ind in scored)
+    for ind in sorted(pop, key=ind_compare)[-ELITE:]:
+        if ind[phenotype_idx] is not None and id(ind[genome_idx]) not in seen:
+            seen.add(id(ind[genome_idx]))
+            scored.append((FITNESS.full_fitness(ind[phenotype_idx]), ind))
+    scored.sort(key=ind_compare) # the full fitness is first, as in an ind
+    ELITE_FULL = scored[-ELITE:]
+    return ELITE_FULL
+
+# Runs once in each worker process, to install the problem there.
+def init_worker(generate, fitness, fitness_batch, local_search,
+                maxv, wraps, maximise):
+    global GENERATE, FITNESS, FITNESS_BATCH, LOCAL_SEARCH
+    global MAXV, WRAPS, MAXIMISE
+    GENERATE, FITNESS, FITNESS_BATCH = generate, fitness, fitness_batch
+    LOCAL_SEARCH = local_search
+    MAXV, WRAPS, MAXIMISE = maxv, wraps, maximise
+
 # Onepoint crossover FIXME change to twopoint?
 def xover(a, b):
+    (c, pt_c), (d, pt_d) = xover_points(a, b)
+    return c, d
+
+# As xover(), but also return for each child the first locus at which
+# it may differ from its own parent: the first child is a copy of a
+# up to that point, the second is a copy of b.
+def xover_points(a, b):
     g, h = a[genome_idx], b[genome_idx]
     if random.random() < CROSSOVER_PROB:
         # -1 to get last index in array; min() in case of wraps: used > len
         max_g, max_h = min(len(g)-1, a[used_idx]), min(len(h)-1, b[used_idx])
         pt_g, pt_h = random.randint(1, max_g), random.randint(1, max_h)
-        c = g[:pt_g] + h[pt_h:]
-        d = h[:pt_h] + g[pt_g:]
-        return c, d
+        c = concatenate(g[:pt_g], h[pt_h:])
+        d = concatenate(h[:pt_h], g[pt_g:])
+        return (c, pt_g), (d, pt_h)
     else:
-        return g[:], h[:]
+        return (copy_genome(g), len(g)), (copy_genome(h), len(h))
 
 # Per-gene bit-flip mutation FIXME allow insert/delete? -- would be
 # more suited to the ripple effect, in a way.  FIXME could switch to
 # float rep and use gaussian mutation could even use gaussian-style
 # mutation on integers...
 def mutate(g):
+    mutate_loci(g)
+    return g
+
+# As mutate(), but return the loci which were changed, in increasing
+# order. Compact genomes are mutated with a single mask.
+def mutate_loci(g):
+    if COMPACT:
+        loci = np.flatnonzero(np_random.random_sample(len(g)) < PMUT)
+        g[loci] = np_random.randint(0, MAXV, len(loci), dtype=np.uint32)
+        return loci
+    loci = []
     for pt in range(len(g)):
         if random.random() < PMUT:
             g[pt] = random.randint(0, MAXV-1)
-    return g
+            loci.append(pt)
+    return loci
+
+# Mutate a whole population of genomes at once: draw the mutation
+# mask for every codon in the population, and the replacement codons,
+# in one call each to np_random. Return for each genome the array of
+# loci which were changed, in increasing order.
+def mutate_population(genomes):
+    lens = np.array([len(g) for g in genomes])
+    ends = np.cumsum(lens)
+    hits = np.flatnonzero(np_random.random_sample(lens.sum()) < PMUT)
+    if COMPACT:
+        vals = np_random.randint(0, MAXV, len(hits), dtype=np.uint32)
+    else:
+        vals = np_random.randint(0, MAXV, len(hits)).tolist()
+    # hits[lo:hi] fall in genome i, where hi is bounds[i]
+    bounds = np.searchsorted(hits, ends)
+    all_loci = []
+    lo = 0
+    for g, start, hi in zip(genomes, ends - lens, bounds):
+        loci = hits[lo:hi] - start
+        if COMPACT:
+            g[loci] = vals[lo:hi]
+        else:
+            for pt, val in zip(loci.tolist(), vals[lo:hi]):
+                g[pt] = val
+        all_loci.append(loci)
+        lo = hi
+    return all_loci
+
+# A child whose edits all fell at or after locus first can only
+# differ from its parent in codons the parent never read, as long as
+# the parent didn't wrap (and so read the tail again) or run out of
+# genome. Then the child will have the same phenotype.
+def is_neutral(parent, first):
+    return (parent[phenotype_idx] is not None and
+            parent[used_idx] <= len(parent[genome_idx]) and
+            first >= parent[used_idx])
+
+# Fitness on unseen data, if FITNESS has a test method, else just
+# FITNESS.
+def test(phenotype):
+    return getattr(FITNESS, "test", FITNESS)(phenotype)
 
 # Print statistics, and return True if we have succeeded already.
+# With a CASE_SCHEDULE, the best individual is the best of the elite
+# on all the cases (see full_elite), and its fitness on all the cases
+# is reported, and decides success.
 def stats(pop, gen):
+    global NEUTRAL_COUNT
     best = max(pop, key=ind_compare)
+    best_fitness = best[fitness_idx]
+    if CASE_SCHEDULE != "full" and full_elite(pop):
+        best_fitness, best = ELITE_FULL[-1]
     valids = [i for i in pop if i[phenotype_idx] is not None]
     ninvalids = len(pop) - len(valids)
     if len(valids) == 0:
@@ -88,11 +340,23 @@ def stats(pop, gen):
     print("{0} {1} {2} {3} {4:.2f} {5:.2f} {6:.2f} {7:.2f} {8:.2f} {9:.2f} {10} : {11}"
           .format(gen, POPSIZE * gen,
                   best[fitness_idx], best[used_idx],
-                  FITNESS.test(best[phenotype_idx]),
+                  test(best[phenotype_idx]),
                   meanfit, sdfit, meanused, sdused,
                   meanlen, sdlen, ninvalids, 
                   best[phenotype_idx]))
-    return SUCCESS(best[fitness_idx])
+    if CASE_SCHEDULE != "full":
+        print("# cases {0} {1} best_full_fitness {2}".format(
+            CASE_SCHEDULE, FITNESS.describe_cases(), best_fitness))
+    if CACHE is not None:
+        print("# cache_hits {0} cache_misses {1}".format(CACHE.hits,
+                                                         CACHE.misses))
+        CACHE.reset_counts()
+    if NEUTRAL_SKIP:
+        print("# neutral_children {0}".format(NEUTRAL_COUNT))
+        NEUTRAL_COUNT = 0
+    for report in REPORTS:
+        print("# " + report())
+    return SUCCESS(best_fitness)
 
 # Use many tournaments to get parents
 def tournament(items):
@@ -100,41 +364,98 @@ def tournament(items):
         candidates = random.sample(items, TOURNAMENT_SIZE)
         yield max(candidates, key=ind_compare)
 
-# Run one generation
-def step(pop):
+# Run one generation, gen. If its fitness cases differ from the last
+# generation's, the elite and any neutral children are rescored on
+# them.
+def step(pop, gen):
+    global NEUTRAL_COUNT, ELITE_FULL
     pop.sort(key=ind_compare)
     assert ELITE < POPSIZE
-    elite = pop[-ELITE:] # best inds: how many? ELITE
+    if CASE_SCHEDULE == "full":
+        elite = pop[-ELITE:] # best inds: how many? ELITE
+    else:
+        elite = [ind for f, ind in full_elite(pop)]
+    rescoring = choose_cases(gen)
+    if rescoring:
+        elite = rescore(elite)
+        if CASE_SCHEDULE != "full":
+            ELITE_FULL = [(f, ind) for (f, old), ind in zip(ELITE_FULL, elite)]
     
-    # crossover: pass inds, get new genomes
-    newpop = []
+    # crossover: pass inds, get new genomes, each with the parent it
+    # copies up to the crossover point
+    children = []
     parents = SELECTION(pop)
-    while len(newpop) < POPSIZE:
-        for child_genome in xover(parents.next(), parents.next()):
-            if len(newpop) < POPSIZE:
-                newpop.append(child_genome)
+    while len(children) < POPSIZE:
+        a, b = parents.next(), parents.next()
+        for (child_genome, pt), parent in zip(xover_points(a, b), (a, b)):
+            if len(children) < POPSIZE:
+                children.append((child_genome, parent, pt))
         
-    # mutation: pass genomes, they'll be changed
-    for genome in newpop:
-        mutate(genome)
+    # mutation: pass genomes, they'll be changed. Note the first
+    # locus at which each child may differ from its parent.
+    if VECTORISED_MUTATION:
+        all_loci = mutate_population([c[0] for c in children])
+    else:
+        all_loci = [mutate_loci(c[0]) for c in children]
+    for i, (genome, parent, pt) in enumerate(children):
+        loci = all_loci[i]
+        if len(loci):
+            children[i] = (genome, parent, min(pt, loci[0]))
 
-    # grow up: turn genomes into individuals
-    newpop = [Individual(g) for g in newpop]
+    # grow up: turn genomes into individuals. With NEUTRAL_SKIP,
+    # neutral children inherit their parent's fitness and phenotype.
+    newpop = [None] * len(children)
+    todo = []
+    neutral = []
+    for i, (genome, parent, first) in enumerate(children):
+        if NEUTRAL_SKIP and is_neutral(parent, first):
+            newpop[i] = (parent[fitness_idx], parent[used_idx],
+                         genome, parent[phenotype_idx])
+            neutral.append(i)
+            NEUTRAL_COUNT += 1
+        else:
+            todo.append(i)
+    for i, ind in zip(todo, evaluate([children[i][0] for i in todo])):
+        newpop[i] = ind
+    if rescoring:
+        for i, ind in zip(neutral, rescore([newpop[i] for i in neutral])):
+            newpop[i] = ind
     
     # elite: replace worst
     newpop.sort(key=ind_compare)
-    newpop[:ELITE] = elite
+    newpop[:len(elite)] = elite
     return newpop
     
 def main(seed=None):
+    global POOL, CACHE, CASES, MAXV, ELITE_FULL
     if seed is not None:
         random.seed(seed)
-    pop = [Individual(None) for i in range(POPSIZE)]
-    for gen in range(GENERATIONS):
-        if stats(pop, gen):
-            sys.exit()
-        pop = step(pop)
-    stats(pop, GENERATIONS)
+        np_random.seed(seed)
+    if COMPACT:
+        MAXV = min(MAXV, 2 ** 32)
+    if CACHE_SIZE > 0:
+        CACHE = new_cache()
+    if NPROCS > 1:
+        POOL = multiprocessing.Pool(NPROCS, init_worker,
+                                    (GENERATE, FITNESS, FITNESS_BATCH,
+                                     LOCAL_SEARCH, MAXV, WRAPS, MAXIMISE))
+    try:
+        choose_cases(0)
+        pop = evaluate([random_genome() for i in range(POPSIZE)])
+        for gen in range(GENERATIONS):
+            if stats(pop, gen):
+                sys.exit()
+            pop = step(pop, gen + 1)
+        stats(pop, GENERATIONS)
+    finally:
+        if POOL is not None:
+            POOL.terminate()
+            POOL = None
+        CACHE = None
+        if CASES is not None:
+            FITNESS.set_cases(None)
+            CASES = None
+        ELITE_FULL = []
 
 # parameters
 GENERATIONS = 100
@@ -148,6 +469,22 @@ MAXV = sys.maxint
 TOURNAMENT_SIZE = 5
 ELITE = 1
 WRAPS = 0
+NPROCS = 1 # worker processes for evaluation: 1 means evaluate serially
+CHUNKSIZE = 100 # genomes sent to a worker at a time
+POOL = None
+CACHE_SIZE = 0 # individuals kept in the evaluation cache: 0 disables it
+CACHE_BYTES = None # optional limit on the evaluation cache's memory
+CACHE = None
+NEUTRAL_SKIP = False # don't re-evaluate children of neutral edits
+NEUTRAL_COUNT = 0
+COMPACT = False # uint32 array genomes, MAXV at most 2 ** 32
+VECTORISED_MUTATION = False # mutate the population in one numpy call
+REPORTS = [] # functions giving a line of extra stats per generation
+CASE_SCHEDULE = "full" # or "minibatch", "interleaved", "racing": see choose_cases
+CASE_SAMPLE = 0.1 # a proportion of the cases (float < 1.0), or a count (int)
+CASES = None
+ELITE_FULL = [] # see full_elite
+np_random = np.random.RandomState()
 
 # problem-specific
 def generate(random):
@@ -158,6 +495,8 @@ def success(x):
     return x > 90
 GENERATE = generate
 FITNESS = fitness
+FITNESS_BATCH = None # optional: list of phenotypes -> list of fitnesses
+LOCAL_SEARCH = None # optional: (phenotype, fitness) -> improved (phenotype, fitness)
 SUCCESS = success
 MAXIMISE = True
 